@@ -69,6 +69,76 @@ STATICFILES_FINDERS = (
 # Make this unique, and don't share it with anybody.
 SECRET_KEY = 'kx9z=f2)b72+y58fg^9qs^gu+(d0=@p#k&amp;b)7f1@0mq!z$97k)'
 
+# Rendered feed and aggregate pages are cached here. Use a shared backend
+# (memcached, or a file-based cache) when running more than one process.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# How long (in seconds) to keep a rendered page. Pages are keyed on the
+# versions of their feeds, so they never go stale, only unused.
+AGGR_PAGE_CACHE_TIMEOUT = 60 * 60
+
+# Entries per page on feed and aggregate pages.
+AGGR_PAGE_SIZE = 50
+
+# The most entries an aggregate's RSS feed will include.
+AGGR_RSS_MAX_ITEMS = 50
+
+# Limits on what one refresh of a feed will read. Past AGGR_MAX_FEED_BYTES
+# the rest of the body is skipped, and only the first AGGR_MAX_FEED_ENTRIES
+# entries in the document are considered.
+AGGR_MAX_FEED_BYTES = 4 * 1024 * 1024
+AGGR_MAX_FEED_ENTRIES = 500
+
+# Seconds a feed fetch may spend connecting, and waiting on any one read.
+AGGR_FETCH_CONNECT_TIMEOUT = 10
+AGGR_FETCH_READ_TIMEOUT = 30
+
+# Politeness towards the hosts feeds are fetched from: the most fetches
+# from one host a process runs at once, and the seconds to leave between
+# starting them.
+AGGR_HOST_MAX_REQUESTS = 2
+AGGR_HOST_MIN_INTERVAL = 0.25
+
+# After AGGR_CIRCUIT_THRESHOLD failed refreshes in a row a feed isn't
+# fetched for AGGR_CIRCUIT_BASE seconds, doubling with each further
+# failure up to AGGR_CIRCUIT_MAX. Its pages keep the last good fetch.
+AGGR_CIRCUIT_THRESHOLD = 3
+AGGR_CIRCUIT_BASE = 10 * 60
+AGGR_CIRCUIT_MAX = 24 * 60 * 60
+
+# Past this many feeds, the aggregate form picks feeds with a search box
+# instead of a <select> listing them all.
+AGGR_FEED_SELECT_LIMIT = 200
+
+# How many RefreshLogs and RebuildLogs to keep for each feed and aggregate.
+# 0 stops recording them.
+AGGR_METRICS_HISTORY = 100
+
+# Only one refresh of a feed runs at a time; the refresher holds a lease
+# on it for at most this many seconds, after which another may take over.
+AGGR_REFRESH_LEASE = 5 * 60
+
+# Pages of feeds this many seconds past their scheduled refresh are still
+# served straight away, but the feeds are refreshed in the background.
+# None leaves refreshing to refresh_worker and refresh_feeds alone.
+AGGR_MAX_STALENESS = 15 * 60
+
+# Reads of feeds and aggregates are counted in memory and written at most
+# this often (in seconds).
+AGGR_ACCESS_FLUSH_INTERVAL = 60
+
+# Feeds read (directly or through an aggregate) within AGGR_HOT_PERIOD
+# seconds are refreshed first, and at least every AGGR_HOT_MAX_INTERVAL
+# seconds unless failing. Feeds unread for AGGR_COLD_PERIOD are refreshed
+# once a day until read again.
+AGGR_HOT_PERIOD = 24 * 60 * 60
+AGGR_HOT_MAX_INTERVAL = 60 * 60
+AGGR_COLD_PERIOD = 14 * 24 * 60 * 60
+
 # List of callables that know how to import templates from various sources.
 TEMPLATE_LOADERS = (
     'django.template.loaders.filesystem.Loader',
@@ -0,0 +1,76 @@
+"""Counts reads of feeds and aggregates, so refreshes can favour what's read.
+
+Reads are counted in memory and written at most every
+AGGR_ACCESS_FLUSH_INTERVAL seconds, one UPDATE per feed or aggregate
+read, however often it was. Counts not yet written when a process
+exits are lost; they only steer refresh priorities.
+"""
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.decorators import available_attrs
+from aggr_app.models import Feed, Aggregate
+from functools import wraps
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class AccessCounter(object):
+    """Batches up reads of Feeds and Aggregates."""
+    def __init__(self):
+        self.counts = {}
+        self.flushed = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, model, pk):
+        """Counts a read of the model instance with the given pk."""
+        interval = getattr(settings, 'AGGR_ACCESS_FLUSH_INTERVAL', 60)
+        with self.lock:
+            key = (model, int(pk))
+            self.counts[key] = self.counts.get(key, 0) + 1
+            due = time.time() - self.flushed >= interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Writes the counts so far.
+
+        Cold feeds that have just been read, directly or through an
+        aggregate, are made hot and due for a refresh straight away.
+        """
+        with self.lock:
+            (counts, self.counts) = (self.counts, {})
+            self.flushed = time.time()
+        if not counts:
+            return
+        now = timezone.now()
+        for ((model, pk), count) in counts.items():
+            model.objects.filter(pk=pk).update(read_count=F('read_count') + count, last_read=now)
+        feed_ids = [pk for (model, pk) in counts if model is Feed]
+        aggr_ids = [pk for (model, pk) in counts if model is Aggregate]
+        woken = Feed.objects.filter(
+            Q(pk__in=feed_ids) | Q(filteredfeed__aggregate__in=aggr_ids),
+            priority=Feed.COLD,
+        ).update(priority=Feed.HOT, next_refresh=now)
+        logger.debug("Recorded reads of %d feeds and aggregates; %d cold feeds woken." % (len(counts), woken))
+
+# Shared by every view in the process.
+counter = AccessCounter()
+
+def counts_reads(model, arg):
+    """Decorates a view to count reads of the model instance its arg names.
+
+    Put it outside cached_page, so pages served from the cache or as
+    304s count too.
+    """
+    def decorator(view):
+        @wraps(view, assigned=available_attrs(view))
+        def wrapped(request, *args, **kwargs):
+            response = view(request, *args, **kwargs)
+            if request.method in ('GET', 'HEAD') and response.status_code in (200, 304):
+                counter.record(model, kwargs[arg])
+            return response
+        return wrapped
+    return decorator
@@ -1,6 +1,17 @@
-from aggr_app.models import Feed, FilteredFeed, Aggregate
+from aggr_app.models import Feed, Entry, FilteredFeed, Aggregate, RefreshLog, RebuildLog
 from django.contrib import admin
 
+class RefreshLogAdmin(admin.ModelAdmin):
+    list_display = ('feed', 'started', 'outcome', 'status', 'total_time', 'wait_time', 'transfer_time', 'parse_time', 'bytes_received', 'entries_added')
+    list_filter = ('outcome',)
+
+class RebuildLogAdmin(admin.ModelAdmin):
+    list_display = ('aggregate', 'started', 'kind', 'total_time', 'filter_time', 'save_time', 'items', 'items_added')
+    list_filter = ('kind',)
+
 admin.site.register(Feed)
+admin.site.register(Entry)
 admin.site.register(FilteredFeed)
 admin.site.register(Aggregate)
+admin.site.register(RefreshLog, RefreshLogAdmin)
+admin.site.register(RebuildLog, RebuildLogAdmin)
@@ -0,0 +1,113 @@
+"""HTTP validators and a rendered-page cache for feed and aggregate pages.
+
+Pages are cached under a key that includes their ETag, and the ETag is
+derived from the versions of the feeds involved. When a feed refresh
+stores new entries its version changes, so the old pages simply stop
+being used; nothing has to be deleted.
+
+Pages are never held up by a refresh. When a page involves feeds that
+are more than AGGR_MAX_STALENESS past their scheduled refresh, it is
+served from what is stored and the feeds are refreshed in the
+background; the next request sees the new versions.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.decorators import available_attrs
+from django.utils import timezone
+from django.views.decorators.http import condition
+from aggr_app.models import Feed, FilteredFeed, Aggregate, Membership, filter_windows
+from aggr_app.refresh import revalidator
+from functools import wraps
+import datetime
+import hashlib
+
+def overdue(due_times, now):
+    """Returns the ids of feeds too far past their refresh time to serve without one.
+
+    due_times is {feed_id: next_refresh}.
+    """
+    staleness = getattr(settings, 'AGGR_MAX_STALENESS', None)
+    if staleness is None:
+        return []
+    limit = now - datetime.timedelta(seconds=staleness)
+    return [feed_id for (feed_id, next_refresh) in due_times.items() if next_refresh < limit]
+
+def revalidate_overdue(due_times):
+    """Starts background refreshes of the overdue feeds among due_times."""
+    stale = overdue(due_times, timezone.now())
+    if stale:
+        revalidator.revalidate(stale)
+
+def feed_validators(request, feed_id):
+    """Returns (etag, None) for a Feed's page, or None if there's no such Feed."""
+    rows = Feed.objects.filter(pk=feed_id).values_list('name', 'version', 'last_updated', 'next_refresh')
+    if not rows:
+        return None
+    (name, version, last_updated, next_refresh) = rows[0]
+    revalidate_overdue({int(feed_id): next_refresh})
+    # The page shows the name too. Renaming doesn't move last_updated,
+    # so, as for aggregates, there's no honest Last-Modified.
+    etag = hashlib.sha1(repr((feed_id, name, version, last_updated))).hexdigest()
+    return (etag, None)
+
+def aggr_validators(request, aggr_id):
+    """Returns (etag, None) for an Aggregate's pages, or None if there's no such Aggregate."""
+    names = Aggregate.objects.filter(pk=aggr_id).values_list('name', flat=True)
+    if not names:
+        return None
+    rows = list(FilteredFeed.objects.filter(aggregate=aggr_id).values_list(
+        'feed', 're_filter', 'feed__version', 'feed__last_updated', 'feed__next_refresh'))
+    revalidate_overdue(dict((row[0], row[4]) for row in rows))
+    # A rescheduled feed hasn't changed the page; leave next_refresh out.
+    state = (aggr_id, names[0], sorted(row[:4] for row in rows))
+    windows = filter_windows((row[0], row[1]) for row in rows)
+    if windows:
+        # Entries leave the page as they age out of date>7d and the like.
+        state += (Membership.objects.aged_out(aggr_id, windows, timezone.now()),)
+    etag = hashlib.sha1(repr(state)).hexdigest()
+    # Renaming an aggregate or changing its filters changes the page
+    # without moving any feed's last_updated, so there's no honest
+    # Last-Modified; clients revalidate with the ETag.
+    return (etag, None)
+
+def cached_page(validators):
+    """Decorates a view to answer conditional GETs and cache what it renders.
+
+    validators is called with the view's arguments and returns
+    (etag, last_modified), or None when the view would 404.
+    """
+    def decorator(view):
+        def get_validators(request, *args, **kwargs):
+            # condition() asks for the ETag and Last-Modified separately;
+            # only work them out once.
+            if not hasattr(request, '_aggr_validators'):
+                request._aggr_validators = validators(request, *args, **kwargs)
+            return request._aggr_validators
+
+        def etag(request, *args, **kwargs):
+            found = get_validators(request, *args, **kwargs)
+            return found and found[0]
+
+        def last_modified(request, *args, **kwargs):
+            found = get_validators(request, *args, **kwargs)
+            return found and found[1]
+
+        @condition(etag_func=etag, last_modified_func=last_modified)
+        @wraps(view, assigned=available_attrs(view))
+        def wrapped(request, *args, **kwargs):
+            found = get_validators(request, *args, **kwargs)
+            if found is None or request.method != 'GET':
+                return view(request, *args, **kwargs)
+            key = 'aggr_app.page.' + hashlib.sha1("%s %s" % (request.get_full_path(), found[0])).hexdigest()
+            page = cache.get(key)
+            if page is not None:
+                (content, content_type) = page
+                return HttpResponse(content, content_type=content_type)
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200:
+                timeout = getattr(settings, 'AGGR_PAGE_CACHE_TIMEOUT', 60 * 60)
+                cache.set(key, (response.content, response['Content-Type']), timeout)
+            return response
+        return wrapped
+    return decorator
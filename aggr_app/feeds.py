@@ -1,13 +1,18 @@
 from django.contrib.syndication.views import Feed as RSSFeed
-from aggr_app.models import Aggregate
+from aggr_app.models import Aggregate, http_datetime
+from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.shortcuts import get_object_or_404
 
 class AggregateFeed(RSSFeed):
     def get_object(self, request, aggr_id):
+        # Feeds are refreshed by refresh_worker; this only reads their entries.
         aggr = get_object_or_404(Aggregate, pk=aggr_id)
-        aggr.apply_filters()
-        aggr.save()
+        aggr.update_items()
+        # ?since=<date> limits the feed to entries published after then.
+        # Dates without a zone are UTC; ones that can't be read are ignored.
+        since = request.GET.get('since')
+        aggr.since = http_datetime(since, None) if since else None
         return aggr
     
     def title(self, aggr):
@@ -27,7 +32,8 @@ class AggregateFeed(RSSFeed):
     #def author_link(self, aggr):
     
     def items(self, aggr):
-        return aggr.items
+        # Most readers only look at the newest entries.
+        return aggr.get_items(limit=getattr(settings, 'AGGR_RSS_MAX_ITEMS', 50), since=aggr.since)
     
     def item_title(self, entry):
         return entry.title
@@ -0,0 +1,411 @@
+"""A small HTTP client for fetching feeds.
+
+Connections are kept alive and pooled per host, so refreshing several
+feeds on the same host (or the same feed again) skips the TCP and TLS
+handshakes. Responses are requested compressed and decompressed as
+they're read. Each response records how long the fetch took, step by
+step, for the refresh metrics.
+
+The client is polite to feed hosts and won't let one of them hang a
+refresh: connecting and each read have their own timeouts, only a few
+requests to any host run at once, and requests to a host are spaced
+out. The limits come from the AGGR_FETCH_* and AGGR_HOST_* settings.
+
+Like urllib, the client goes through the proxies named by the
+http_proxy and https_proxy environment variables, except to the hosts
+in no_proxy. https is tunnelled through the proxy with CONNECT.
+"""
+from django.conf import settings
+import base64
+import httplib
+import socket
+import ssl
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+class FetchError(Exception):
+    pass
+
+class HostBusy(FetchError):
+    """Raised when a host already has as many requests in progress as it may.
+
+    Nothing was sent, so it says nothing about the URL being fetched.
+    """
+
+class Response(object):
+    """A response from FetchClient.get.
+
+    status and headers are available straight away; the body is read
+    (and decompressed) with read(). Always close() the response, so its
+    connection can go back to the pool.
+
+    timings holds seconds spent on 'dns', 'connect' (including TLS),
+    'wait' (sending the request until the headers arrive) and
+    'transfer' (reading the body); dns and connect are 0 on a reused
+    connection. bytes_received counts the body as sent, before
+    decompression.
+    """
+    # Remaining bodies up to this size are read off and thrown away on
+    # close() so the connection can be reused; bigger ones close it.
+    drain_limit = 64 * 1024
+
+    def __init__(self, client, key, conn, raw, url, timings):
+        self.client = client
+        self.key = key
+        self.conn = conn
+        self.raw = raw
+        self.url = url
+        self.status = raw.status
+        self.headers = raw.msg
+        self.timings = timings
+        self.timings['transfer'] = 0.0
+        self.bytes_received = 0
+        self.buffer = ''
+        # Compressed data not yet decompressed, and whether the
+        # decompressor has been flushed at the end of the body.
+        self.pending = ''
+        self.flushed = False
+        encoding = (raw.getheader('Content-Encoding') or '').lower()
+        if encoding == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self.decompressor = _DeflateDecompressor()
+        else:
+            self.decompressor = None
+
+    def read(self, size):
+        """Returns up to size bytes of the decoded body; '' at the end.
+
+        Decompression is bounded by size too, so a small compressed
+        body can't blow up into a huge one in memory.
+        """
+        while len(self.buffer) < size:
+            if self.pending:
+                self.buffer += self.decompressor.decompress(self.pending, size - len(self.buffer))
+                self.pending = self.decompressor.unconsumed_tail
+            elif not self.raw.isclosed():
+                started = time.time()
+                data = self.raw.read(size)
+                self.timings['transfer'] += time.time() - started
+                self.bytes_received += len(data)
+                if self.decompressor:
+                    self.pending = data
+                else:
+                    self.buffer += data
+            elif self.decompressor and not self.flushed:
+                self.buffer += self.decompressor.flush()
+                self.flushed = True
+            else:
+                break
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return data
+
+    def close(self):
+        """Hands the connection back to the pool, or closes it if it can't be reused."""
+        if self.conn is None:
+            return
+        try:
+            if not self.raw.isclosed() and self.raw.length is not None and self.raw.length <= self.drain_limit:
+                self.raw.read()
+            if self.raw.isclosed() and not self.raw.will_close:
+                self.client.release(self.key, self.conn)
+            else:
+                self.conn.close()
+        except (httplib.HTTPException, socket.error):
+            self.conn.close()
+        finally:
+            self.conn = None
+            self.client.leave(self.key)
+
+class _DeflateDecompressor(object):
+    """Decompresses 'deflate' bodies, which servers send with or without the zlib header."""
+    def __init__(self):
+        self.decompressor = None
+
+    def decompress(self, data, max_length):
+        if self.decompressor is None:
+            self.decompressor = zlib.decompressobj()
+            try:
+                return self.decompressor.decompress(data, max_length)
+            except zlib.error:
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.decompressor.decompress(data, max_length)
+
+    @property
+    def unconsumed_tail(self):
+        return self.decompressor.unconsumed_tail
+
+    def flush(self):
+        return self.decompressor.flush() if self.decompressor else ''
+
+class _TimedConnectionMixin:
+    """Connects like httplib does, but times the name lookup separately.
+
+    Connecting is limited by connect_timeout; once connected, reads are
+    limited by the usual timeout.
+
+    Not derived from object: httplib's connections are old-style classes.
+    """
+    dns_seconds = 0.0
+    connect_seconds = 0.0
+    connect_timeout = None
+
+    def _open_socket(self):
+        started = time.time()
+        addresses = _resolve(self.host, self.port, self.connect_timeout or self.timeout)
+        self.dns_seconds = time.time() - started
+        error = socket.error("No addresses for %s" % self.host)
+        for (family, socktype, proto, canonname, address) in addresses:
+            sock = socket.socket(family, socktype, proto)
+            try:
+                sock.settimeout(self.connect_timeout or self.timeout)
+                sock.connect(address)
+                return sock
+            except socket.error, error:
+                sock.close()
+        raise error
+
+def _resolve(host, port, timeout):
+    """Looks a host up like getaddrinfo, giving up after timeout seconds.
+
+    getaddrinfo itself can't be interrupted, so it runs in a thread of
+    its own, which is left to finish in the background on a timeout.
+    """
+    result = []
+
+    def lookup():
+        try:
+            result.append(socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM))
+        except Exception, e:
+            result.append(e)
+
+    thread = threading.Thread(target=lookup, name="resolve-%s" % host)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    if not result:
+        raise socket.timeout("Timed out looking up %s" % host)
+    if isinstance(result[0], Exception):
+        raise result[0]
+    return result[0]
+
+class _HTTPConnection(_TimedConnectionMixin, httplib.HTTPConnection):
+    def connect(self):
+        started = time.time()
+        self.sock = self._open_socket()
+        self.sock.settimeout(self.timeout)
+        self.connect_seconds = time.time() - started - self.dns_seconds
+
+class _HTTPSConnection(_TimedConnectionMixin, httplib.HTTPSConnection):
+    def connect(self):
+        started = time.time()
+        sock = self._open_socket()
+        if self._tunnel_host:
+            # Connected to a proxy; have it open the way to the host.
+            self.sock = sock
+            self._tunnel()
+        if hasattr(self, '_context'):
+            self.sock = self._context.wrap_socket(sock, server_hostname=self._tunnel_host or self.host)
+        else:
+            self.sock = ssl.wrap_socket(sock, self.key_file, self.cert_file)
+        self.sock.settimeout(self.timeout)
+        self.connect_seconds = time.time() - started - self.dns_seconds
+
+class FetchClient(object):
+    """Fetches URLs over kept-alive, per-host pooled connections.
+
+    max_idle: the most idle connections kept for any one host.
+    proxies: {scheme: proxy URL}; by default, urllib.getproxies().
+
+    A request holds one of its host's AGGR_HOST_MAX_REQUESTS slots until
+    its response is closed. Requests beyond that wait for a slot, for up
+    to the connect timeout, and then fail with HostBusy.
+    """
+    redirect_codes = (301, 302, 303, 307, 308)
+
+    def __init__(self, max_idle=4, max_redirects=5, proxies=None):
+        self.max_idle = max_idle
+        self.max_redirects = max_redirects
+        if proxies is None:
+            proxies = urllib.getproxies()
+        self.proxies = proxies
+        self.idle = {}
+        self.lock = threading.Lock()
+        # Requests in progress and the earliest next start, by host.
+        self.active = {}
+        self.next_start = {}
+        self.slots = threading.Condition()
+
+    @property
+    def connect_timeout(self):
+        return getattr(settings, 'AGGR_FETCH_CONNECT_TIMEOUT', 10)
+
+    @property
+    def read_timeout(self):
+        return getattr(settings, 'AGGR_FETCH_READ_TIMEOUT', 30)
+
+    @property
+    def per_host(self):
+        return getattr(settings, 'AGGR_HOST_MAX_REQUESTS', 2)
+
+    @property
+    def min_interval(self):
+        return getattr(settings, 'AGGR_HOST_MIN_INTERVAL', 0)
+
+    def get(self, url, headers=None):
+        """Sends a GET and returns a Response, following redirects."""
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', 'gzip, deflate')
+        headers.setdefault('User-Agent', 'aggr')
+        for i in range(self.max_redirects + 1):
+            response = self._get(url, headers)
+            location = response.headers.get('Location')
+            if response.status not in self.redirect_codes or not location:
+                return response
+            response.close()
+            url = urlparse.urljoin(url, location)
+            logger.debug("Redirected to %s" % url)
+        raise FetchError("Too many redirects fetching %s" % url)
+
+    def _get(self, url, headers):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise FetchError("Can't fetch %s" % url)
+        key = (parts.scheme, parts.netloc.lower())
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers['Host'] = parts.netloc
+        proxy = self.proxy(key)
+        if proxy and parts.scheme == 'http':
+            # Plain requests go to the proxy whole.
+            path = urlparse.urlunsplit(parts[:4] + ('',))
+            # A copy: a redirect elsewhere mustn't pass the credentials on.
+            headers = dict(headers, **proxy[2])
+
+        self.enter(key)
+        try:
+            return self._request(key, path, headers, url)
+        except:
+            self.leave(key)
+            raise
+
+    def _request(self, key, path, headers, url):
+        conn = self.acquire(key)
+        if conn is not None:
+            try:
+                return self._send(key, conn, path, headers, url)
+            except (httplib.HTTPException, socket.error):
+                # The server probably closed the idle connection; use a fresh one.
+                conn.close()
+        conn = self.connect(key)
+        try:
+            return self._send(key, conn, path, headers, url)
+        except:
+            conn.close()
+            raise
+
+    def _send(self, key, conn, path, headers, url):
+        fresh = conn.sock is None
+        started = time.time()
+        conn.request('GET', path, headers=headers)
+        raw = conn.getresponse()
+        timings = {'dns': 0.0, 'connect': 0.0}
+        if fresh:
+            timings = {'dns': conn.dns_seconds, 'connect': conn.connect_seconds}
+        timings['wait'] = time.time() - started - timings['dns'] - timings['connect']
+        return Response(self, key, conn, raw, url, timings)
+
+    def connect(self, key):
+        (scheme, netloc) = key
+        proxy = self.proxy(key)
+        if proxy and scheme == 'https':
+            conn = _HTTPSConnection(proxy[0], proxy[1], timeout=self.read_timeout)
+            conn.set_tunnel(netloc, headers=proxy[2])
+        elif proxy:
+            conn = _HTTPConnection(proxy[0], proxy[1], timeout=self.read_timeout)
+        elif scheme == 'https':
+            conn = _HTTPSConnection(netloc, timeout=self.read_timeout)
+        else:
+            conn = _HTTPConnection(netloc, timeout=self.read_timeout)
+        conn.connect_timeout = self.connect_timeout
+        return conn
+
+    def proxy(self, key):
+        """Returns (host, port, headers) of the proxy to reach key through, or None."""
+        (scheme, netloc) = key
+        proxy = self.proxies.get(scheme)
+        if not proxy or urllib.proxy_bypass(netloc):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        parts = urlparse.urlsplit(proxy)
+        headers = {}
+        if parts.username:
+            credentials = '%s:%s' % (urllib.unquote(parts.username), urllib.unquote(parts.password or ''))
+            headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials)
+        return (parts.hostname, parts.port, headers)
+
+    def enter(self, key):
+        """Takes a request slot for the host, then waits for its turn."""
+        host = key[1]
+        give_up = time.time() + self.connect_timeout
+        with self.slots:
+            while self.active.get(host, 0) >= self.per_host:
+                remaining = give_up - time.time()
+                if remaining <= 0:
+                    raise HostBusy("Too many requests to %s in progress" % host)
+                self.slots.wait(remaining)
+            self.active[host] = self.active.get(host, 0) + 1
+            now = time.time()
+            start = max(now, self.next_start.get(host, 0))
+            self.next_start[host] = start + self.min_interval
+        if start > now:
+            time.sleep(start - now)
+
+    def leave(self, key):
+        """Gives up a request slot taken by enter()."""
+        host = key[1]
+        with self.slots:
+            self.active[host] -= 1
+            if not self.active[host]:
+                del self.active[host]
+                if self.next_start.get(host, 0) <= time.time():
+                    self.next_start.pop(host, None)
+            self.slots.notify_all()
+
+    def acquire(self, key):
+        """Returns an idle connection to the host, or None."""
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                return idle.pop()
+        return None
+
+    def release(self, key, conn):
+        """Puts a connection back in the pool for its host."""
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Closes every idle connection."""
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+# Shared by every feed refresh in the process.
+client = FetchClient()
@@ -0,0 +1,330 @@
+"""Compiled entry filters.
+
+Patterns are compiled once and kept in a small LRU cache, and all the
+filters an aggregate has on one feed are combined so each entry is
+only examined once. Filters that are only literal text are noted, so
+the full-text index can find their candidates.
+
+A filter can also be an expression over the entry's fields, such as
+"category:python and not author:bob and date>7d". Expressions become
+database queries, so they use the indexes on the tags, authors and
+publish times rather than reading every entry. Predicates are:
+
+    title:WORD, summary:WORD, text:WORD, author:WORD
+        the field contains WORD, ignoring case; "quote" to include spaces.
+        A WORD on its own means text:WORD.
+    tag:WORD, category:WORD
+        the entry has the tag (feeds call them categories).
+    date>WHEN, date>=WHEN, date<WHEN, date<=WHEN
+        published after or before WHEN, either a date or an age such
+        as 12h, 7d or 2w; date>7d is the last week's entries.
+
+Predicates are combined with and, or, not and parentheses; predicates
+side by side are and-ed. A filter is an expression if it uses one of
+the field prefixes or compares date, and is a regex otherwise.
+
+Entries are matched once, as they're stored, but ages go on changing.
+So an age may only limit a whole filter to recent entries, as in
+"category:python and date>7d"; the limit (the filter's window) is
+applied again whenever the aggregate is read. Ages anywhere else
+(date<7d, or under "or" or "not") are rejected.
+"""
+from collections import OrderedDict
+from django.db.models import Q
+from django.utils import timezone
+from dateutil import parser
+import datetime
+import threading
+import re
+
+class FilterError(ValueError):
+    pass
+
+class LRUCache(object):
+    """A thread-safe mapping that forgets its least recently used keys."""
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return default
+            self.data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+_compiled = LRUCache(500)
+
+def compile_filter(pattern):
+    """Returns the compiled regex for a filter pattern, compiling it at most once."""
+    compiled = _compiled.get(pattern)
+    if compiled is None:
+        compiled = re.compile(pattern)
+        _compiled.set(pattern, compiled)
+    return compiled
+
+def check_filter(pattern):
+    """Raises FilterError if a filter isn't a valid expression or regex."""
+    if is_expression(pattern):
+        compile_expression(pattern)
+        return
+    try:
+        compile_filter(pattern)
+    except re.error, e:
+        raise FilterError("Bad regular expression: %s" % e)
+
+def _combinable(pattern):
+    """Whether a pattern means the same thing inside an alternation.
+
+    Groups would be renumbered, breaking backreferences, and inline
+    flags would apply to every alternative.
+    """
+    return compile_filter(pattern).groups == 0 and not pattern.startswith('(?')
+
+_literal = re.compile(r'^[^\\.^$*+?{}\[\]()|]+$')
+
+def literal_terms(pattern):
+    """Returns the alternatives of a pattern that is only literal text, or None."""
+    terms = pattern.split('|')
+    if all(_literal.match(term) for term in terms):
+        return terms
+    return None
+
+_fields = ('title', 'summary', 'text', 'author', 'tag', 'category')
+_expression_hint = re.compile(r'(?:^|[\s(])(?:(?:%s):|date\s*[<>])' % '|'.join(_fields))
+_token = re.compile(r"""\s*(?:
+    (?P<paren>[()])
+  | date\s*(?P<op>[<>]=?)\s*(?P<when>[^\s()]+)
+  | (?P<field>%s):(?:"(?P<quoted>(?:[^"]|"")*)"|(?P<value>[^\s()"]+))
+  | (?P<word>[^\s()"]+)
+)""" % '|'.join(_fields), re.X)
+_age = re.compile(r'^(\d+)([hdw])$')
+_age_units = {'h': 'hours', 'd': 'days', 'w': 'weeks'}
+_lookups = {'>': 'gt', '>=': 'gte', '<': 'lt', '<=': 'lte'}
+_columns = {'title': 'title', 'summary': 'summary', 'text': 'search_text', 'author': 'author'}
+
+def is_expression(pattern):
+    """Whether a filter is a field expression rather than a regex."""
+    return bool(pattern and _expression_hint.search(pattern))
+
+def _tokenize(pattern):
+    """Returns the tokens of an expression: keywords, parentheses and predicates."""
+    tokens = []
+    position = 0
+    pattern = pattern.strip()
+    while position < len(pattern):
+        match = _token.match(pattern, position)
+        if not match:
+            raise FilterError("Can't understand %r" % pattern[position:])
+        position = match.end()
+        if match.group('paren'):
+            tokens.append((match.group('paren'),))
+        elif match.group('op'):
+            tokens.append(('date', match.group('op'), _parse_when(match.group('when'))))
+        elif match.group('field'):
+            field = match.group('field')
+            value = match.group('value')
+            if value is None:
+                value = match.group('quoted').replace('""', '"')
+            tokens.append(('tag' if field == 'category' else field, value))
+        elif match.group('word').lower() in ('and', 'or', 'not'):
+            tokens.append((match.group('word').lower(),))
+        else:
+            tokens.append(('text', match.group('word')))
+    return tokens
+
+def _parse_when(when):
+    """Returns a timedelta for an age such as 7d, or an aware datetime for a date."""
+    age = _age.match(when)
+    if age:
+        return datetime.timedelta(**{_age_units[age.group(2)]: int(age.group(1))})
+    try:
+        parsed = parser.parse(when)
+    except (ValueError, OverflowError):
+        raise FilterError("Bad date %r" % when)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, timezone.utc)
+    return parsed
+
+class _Parser(object):
+    """Parses expression tokens into a tree of ('and', a, b), ('or', a, b), ('not', a) and predicates."""
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][0]
+        return None
+
+    def take(self):
+        self.position += 1
+        return self.tokens[self.position - 1]
+
+    def parse(self):
+        tree = self.parse_or()
+        if self.peek() is not None:
+            raise FilterError("Unexpected %r" % self.peek())
+        return tree
+
+    def parse_or(self):
+        tree = self.parse_and()
+        while self.peek() == 'or':
+            self.take()
+            tree = ('or', tree, self.parse_and())
+        return tree
+
+    def parse_and(self):
+        tree = self.parse_not()
+        while self.peek() not in (None, 'or', ')'):
+            if self.peek() == 'and':
+                self.take()
+            tree = ('and', tree, self.parse_not())
+        return tree
+
+    def parse_not(self):
+        if self.peek() == 'not':
+            self.take()
+            return ('not', self.parse_not())
+        return self.parse_atom()
+
+    def parse_atom(self):
+        kind = self.peek()
+        if kind == '(':
+            self.take()
+            tree = self.parse_or()
+            if self.peek() != ')':
+                raise FilterError("Missing )")
+            self.take()
+            return tree
+        if kind in _columns or kind in ('tag', 'date'):
+            return self.take()
+        raise FilterError("Expected a predicate, not %r" % (kind or "the end"))
+
+class Expression(object):
+    """A parsed filter expression; query() turns it into a query on Entries."""
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.tree = _Parser(_tokenize(pattern)).parse()
+        self.window = _window(self.tree)
+
+    def query(self, now=None):
+        """Returns a Q object selecting the Entries the expression matches.
+
+        now: what ages such as date>7d are measured from.
+        """
+        return self._query(self.tree, now or timezone.now())
+
+    def _query(self, node, now):
+        kind = node[0]
+        if kind == 'and':
+            return self._query(node[1], now) & self._query(node[2], now)
+        if kind == 'or':
+            return self._query(node[1], now) | self._query(node[2], now)
+        if kind == 'not':
+            return ~self._query(node[1], now)
+        if kind == 'date':
+            (op, when) = node[1:]
+            if isinstance(when, datetime.timedelta):
+                when = now - when
+            return Q(**{'published__%s' % _lookups[op]: when})
+        if kind == 'tag':
+            # A subquery, so that several tag predicates can be combined
+            # without them all having to hold for the same tag row.
+            from aggr_app.models import EntryTag
+            return Q(id__in=EntryTag.objects.filter(term=node[1].lower()).values('entry'))
+        return Q(**{'%s__icontains' % _columns[kind]: node[1]})
+
+def _window(tree):
+    """Returns the age a parsed expression limits entries to (7d for date>7d), or None.
+
+    Raises FilterError for ages that don't just limit the whole
+    expression to recent entries.
+    """
+    conjuncts = []
+    nodes = [tree]
+    while nodes:
+        node = nodes.pop()
+        if node[0] == 'and':
+            nodes.extend(node[1:])
+        else:
+            conjuncts.append(node)
+    windows = [node[2] for node in conjuncts
+               if node[0] == 'date' and node[1] in ('>', '>=') and isinstance(node[2], datetime.timedelta)]
+    if len(windows) != _count_ages(tree):
+        raise FilterError("An age can only limit a filter to recent entries, as in \"date>7d and ...\"")
+    return min(windows) if windows else None
+
+def _count_ages(node):
+    if node[0] in ('and', 'or', 'not'):
+        return sum(_count_ages(child) for child in node[1:])
+    return int(node[0] == 'date' and isinstance(node[2], datetime.timedelta))
+
+def compile_expression(pattern):
+    """Returns the Expression for a filter, parsing it at most once."""
+    expression = _compiled.get(('expression', pattern))
+    if expression is None:
+        expression = Expression(pattern)
+        _compiled.set(('expression', pattern), expression)
+    return expression
+
+class FilterSet(object):
+    """Tests entries against several filter patterns in one pass.
+
+    An empty (or missing) pattern matches everything, and so makes the
+    whole set match everything. If every regex is literal text, terms
+    is the list of strings one of which a matching entry must contain.
+    Expressions aren't tested here; query() combines them for the
+    database.
+
+    window is the age the set limits entries to: the widest of the
+    expressions' windows, or None if any pattern has none.
+    """
+    def __init__(self, patterns):
+        patterns = sorted(set(patterns))
+        self.match_all = not patterns or any(not p for p in patterns)
+        self.regexes = []
+        self.expressions = []
+        self.terms = None
+        self.window = None
+        if self.match_all:
+            return
+        self.expressions = [compile_expression(p) for p in patterns if is_expression(p)]
+        if all(e.window for e in self.expressions) and len(self.expressions) == len(patterns):
+            self.window = max(e.window for e in self.expressions)
+        patterns = [p for p in patterns if not is_expression(p)]
+        if not patterns:
+            return
+        literals = [literal_terms(p) for p in patterns]
+        if all(literals):
+            self.terms = sorted(set(term for terms in literals for term in terms))
+        if all(_combinable(p) for p in patterns):
+            self.regexes = [compile_filter('|'.join('(?:%s)' % p for p in patterns))]
+        else:
+            self.regexes = [compile_filter(p) for p in patterns]
+
+    def query(self, now=None):
+        """Returns a Q object for Entries matching any of the expressions, or None."""
+        if not self.expressions:
+            return None
+        return reduce(lambda a, b: a | b, [e.query(now) for e in self.expressions])
+
+    def matches(self, *texts):
+        """Whether any of the texts matches any of the regexes."""
+        if self.match_all:
+            return True
+        return any(regex.search(text) for regex in self.regexes for text in texts)
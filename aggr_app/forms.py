@@ -1,7 +1,45 @@
 from django import forms
+from django.conf import settings
 from aggr_app.models import Feed
+from aggr_app.filters import check_filter, FilterError
 
-feed_choices = tuple([(feed.id, feed.name) for feed in Feed.objects.all()])
+def validate_filter(value):
+    """Rejects filters that are neither a valid expression nor a valid regex."""
+    try:
+        check_filter(value)
+    except FilterError, e:
+        raise forms.ValidationError(unicode(e))
+
+class FeedField(forms.ChoiceField):
+    """Chooses a Feed by id.
+    
+    Up to AGGR_FEED_SELECT_LIMIT feeds, a <select> of them all. Past
+    that, a text input that the aggregate form's script fills in from
+    the feed search view, since a <select> per filter of thousands of
+    feeds is too much to send.
+    """
+    def __init__(self, names, *args, **kwargs):
+        self.names = names
+        if len(names) > getattr(settings, 'AGGR_FEED_SELECT_LIMIT', 200):
+            kwargs['widget'] = forms.TextInput(attrs={'class': 'feed-search', 'list': 'feed-options'})
+            kwargs['choices'] = ()
+        else:
+            kwargs['choices'] = sorted(names.items(), key=lambda (id, name): name.lower())
+        super(FeedField, self).__init__(*args, **kwargs)
+    
+    def valid_value(self, value):
+        try:
+            id = int(value)
+        except (TypeError, ValueError):
+            return False
+        if id in self.names:
+            return True
+        # The names may have been cached before another process added
+        # the feed; ask the database, and have them read again.
+        if Feed.objects.filter(pk=id).exists():
+            Feed.objects.forget_names()
+            return True
+        return False
 
 class NewFeedForm(forms.Form):
     name = forms.CharField(max_length=100, required=True)
@@ -28,9 +66,10 @@ class NewAggrForm(forms.Form):
         if filter_count < len(filters):
             filter_count = len(filters)
         self.fields['filter_count'].initial = filter_count
+        names = Feed.objects.names()
         for i in range(filter_count):
-            self.fields['feed%d' % i] = forms.ChoiceField(choices=feed_choices)
-            self.fields['filter%d' % i] = forms.CharField(max_length=400)
+            self.fields['feed%d' % i] = FeedField(names)
+            self.fields['filter%d' % i] = forms.CharField(max_length=400, validators=[validate_filter])
         for i in range(len(filters)):
             self.fields['feed%d' % i].initial = filters[i][0]
             self.fields['filter%d' % i].initial = filters[i][1]
@@ -0,0 +1,11 @@
+from django.db import connections
+from django.db.models.signals import post_syncdb
+from aggr_app import models as aggr_models
+from aggr_app import search
+
+def create_search_index(sender, created_models, db, **kwargs):
+    """Adds the full-text index when syncdb creates the Entry table."""
+    if aggr_models.Entry in created_models:
+        search.create_index(connections[db], aggr_models.Entry._meta.db_table)
+
+post_syncdb.connect(create_search_index, sender=aggr_models)
@@ -0,0 +1,227 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+from django.test.utils import override_settings
+from django.utils import timezone
+from aggr_app.models import Feed, FilteredFeed, Aggregate
+from aggr_app import fetch
+from optparse import make_option
+import BaseHTTPServer
+import SocketServer
+import datetime
+import threading
+import json
+import time
+
+# Changes smaller than this many seconds are noise, however large in percent.
+NOISE = 0.005
+
+WORDS = ('python', 'django', 'ruby', 'rust', 'linux', 'release', 'security', 'news', 'update', 'database')
+
+class Command(BaseCommand):
+    help = ("Times feed refreshes, filtering and page rendering against synthetic feeds "
+            "served locally. Runs in a throwaway test database.")
+    option_list = BaseCommand.option_list + (
+        make_option('--scales', dest='scales', default='10x100,100x100',
+            help='Comma-separated FEEDSxENTRIES sizes to run, entries being per feed. Default 10x100,100x100.'),
+        make_option('--repeat', type='int', dest='repeat', default=3,
+            help='Times to repeat the repeatable measurements; the best is kept. Default 3.'),
+        make_option('--output', dest='output', default=None,
+            help='Write the results to this file as JSON.'),
+        make_option('--compare', dest='compare', default=None,
+            help='Compare with results written by an earlier --output, and fail on regressions.'),
+        make_option('--threshold', type='float', dest='threshold', default=20.0,
+            help='Percentage slowdown counted as a regression when comparing. Default 20.'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            scales = [tuple(int(n) for n in scale.split('x')) for scale in options['scales'].split(',')]
+        except ValueError:
+            raise CommandError("Scales look like 10x100: feeds x entries per feed.")
+        server = FeedServer()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = {}
+            for (feeds, entries) in scales:
+                # Every feed is on the one local server; don't space out
+                # requests to it as if it were someone else's.
+                with override_settings(AGGR_MAX_FEED_ENTRIES=entries, AGGR_HOST_MIN_INTERVAL=0):
+                    results['%dx%d' % (feeds, entries)] = self.run_scale(server, feeds, entries, options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            server.close()
+
+        self.report(results)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=1, sort_keys=True)
+        if options['compare']:
+            with open(options['compare']) as f:
+                regressions = self.compare(json.load(f), results, options['threshold'])
+            if regressions:
+                raise CommandError("%d measurements regressed by more than %g%%." % (regressions, options['threshold']))
+
+    def run_scale(self, server, feed_count, entry_count, repeat):
+        """Builds feeds and an aggregate over them; returns seconds per measurement."""
+        Feed.objects.all().delete()
+        Aggregate.objects.all().delete()
+        server.entries = entry_count
+        feeds = [Feed.objects.create(name="Feed %d" % n, url=server.url(n)) for n in range(feed_count)]
+        results = {}
+
+        # Refreshes run in this thread: the test database may only exist
+        # on this thread's connection.
+        started = time.time()
+        for feed in feeds:
+            feed.update_cache(force=True)
+        results['refresh_full'] = time.time() - started
+        for feed in feeds:
+            feed.last_updated -= Feed.minimum_refresh_time
+        started = time.time()
+        for feed in feeds:
+            feed.update_cache()
+        results['refresh_not_modified'] = time.time() - started
+
+        aggr = Aggregate.objects.create(name="Benchmark")
+        filters = ['', 'python|django', '[Ss]ecurity .* update', 'category:news and date>30d']
+        aggr.feeds = [
+            FilteredFeed.objects.create(feed=feed, re_filter=filters[n % len(filters)])
+            for (n, feed) in enumerate(feeds)
+        ]
+        results['apply_filters'] = best_of(repeat, aggr.apply_filters)
+        results['apply_filters_limit_50'] = best_of(repeat, lambda: aggr.apply_filters(limit=50))
+        results['update_items'] = timed(aggr.update_items)
+
+        client = Client()
+        page = reverse('aggr_app.views.aggr_detail', args=(aggr.id,))
+        rss = reverse('aggr-rss', args=(aggr.id,))
+        # The pages haven't been rendered at these feed versions, so the
+        # first request of each renders; the rest come from the page cache.
+        results['aggr_detail_render'] = timed(lambda: get(client, page))
+        results['aggr_detail_cached'] = best_of(repeat, lambda: get(client, page))
+        results['rss_render'] = timed(lambda: get(client, rss))
+        results['rss_cached'] = best_of(repeat, lambda: get(client, rss))
+        results['entries'] = feed_count * entry_count
+        return results
+
+    def report(self, results):
+        for scale in sorted(results, key=lambda s: [int(n) for n in s.split('x')]):
+            self.stdout.write("%s (feeds x entries per feed):\n" % scale)
+            for (name, value) in sorted(results[scale].items()):
+                if name == 'entries':
+                    continue
+                self.stdout.write("  %-24s %9.4fs\n" % (name, value))
+
+    def compare(self, old, new, threshold):
+        """Writes the change in each measurement found in both runs; returns the number of regressions."""
+        regressions = 0
+        for scale in sorted(set(old) & set(new)):
+            for name in sorted(set(old[scale]) & set(new[scale])):
+                if name == 'entries' or not old[scale][name]:
+                    continue
+                change = (new[scale][name] - old[scale][name]) / old[scale][name] * 100
+                regressed = change > threshold and new[scale][name] - old[scale][name] > NOISE
+                regressions += regressed
+                self.stdout.write("%s %-24s %+7.1f%%%s\n" % (scale, name, change, "  REGRESSION" if regressed else ""))
+        return regressions
+
+def timed(function):
+    started = time.time()
+    function()
+    return time.time() - started
+
+def best_of(repeat, function):
+    return min(timed(function) for i in range(max(repeat, 1)))
+
+def get(client, path, **extra):
+    response = client.get(path, **extra)
+    if response.status_code != 200:
+        raise CommandError("%s returned %d" % (path, response.status_code))
+    return response
+
+def synthetic_feed(number, entries):
+    """Returns a feed document with the given number of entries, newest first.
+
+    Even numbered feeds are RSS and odd ones Atom. Titles are drawn from
+    WORDS, so filters match a predictable share of the entries.
+    """
+    newest = datetime.datetime.now(timezone.utc).replace(microsecond=0)
+    items = []
+    for i in range(entries):
+        published = newest - datetime.timedelta(hours=i)
+        title = "%s %s %d" % (WORDS[i % len(WORDS)], WORDS[(i * 7 + number) % len(WORDS)], i)
+        summary = "&lt;p&gt;About &lt;b&gt;%s&lt;/b&gt; in feed %d.&lt;/p&gt;" % (title, number)
+        category = WORDS[(i + number) % len(WORDS)]
+        if number % 2:
+            items.append(
+                "<entry><id>urn:benchmark:%d:%d</id><title>%s</title><link href=\"http://example.com/%d/%d\"/>"
+                "<summary type=\"html\">%s</summary><category term=\"%s\"/><updated>%s</updated></entry>"
+                % (number, i, title, number, i, summary, category, published.strftime('%Y-%m-%dT%H:%M:%SZ'))
+            )
+        else:
+            items.append(
+                "<item><guid>urn:benchmark:%d:%d</guid><title>%s</title><link>http://example.com/%d/%d</link>"
+                "<description>%s</description><category>%s</category><pubDate>%s</pubDate></item>"
+                % (number, i, title, number, i, summary, category, published.strftime('%a, %d %b %Y %H:%M:%S GMT'))
+            )
+    if number % 2:
+        return ("<?xml version=\"1.0\"?><feed xmlns=\"http://www.w3.org/2005/Atom\"><title>Feed %d</title>%s</feed>"
+                % (number, "".join(items)))
+    return "<?xml version=\"1.0\"?><rss version=\"2.0\"><channel><title>Feed %d</title>%s</channel></rss>" % (number, "".join(items))
+
+class FeedServer(object):
+    """Serves synthetic feeds at /<number>, with ETags so refreshes can get a 304."""
+    def __init__(self):
+        self.entries = 0
+        self.bodies = {}
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers are written a line at a time; don't let Nagle's
+            # algorithm hold each response up.
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                number = int(self.path.strip('/'))
+                etag = '"%d-%d"' % (number, server.entries)
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = server.body(number)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/xml')
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.httpd = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def url(self, number):
+        return 'http://127.0.0.1:%d/%d' % (self.httpd.server_port, number)
+
+    def body(self, number):
+        key = (number, self.entries)
+        if key not in self.bodies:
+            self.bodies[key] = synthetic_feed(number, self.entries)
+        return self.bodies[key]
+
+    def close(self):
+        fetch.client.close()
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+from aggr_app.models import Feed, Aggregate
+from aggr_app.refresh import FeedRefresher
+from optparse import make_option
+import time
+
+class Command(BaseCommand):
+    args = '[feed_id ...]'
+    help = "Refreshes all feeds, or the given ones, once and reports how it went. Suitable for cron."
+    option_list = BaseCommand.option_list + (
+        make_option('--concurrency', type='int', dest='concurrency', default=8,
+            help='Number of feeds to fetch at once. Default 8.'),
+        make_option('--per-host', type='int', dest='per_host', default=None,
+            help='Number of feeds to fetch at once from any one host. Default, and most, AGGR_HOST_MAX_REQUESTS.'),
+        make_option('--only-due', action='store_true', dest='only_due', default=False,
+            help='Only refresh feeds that are due: their scheduled refresh time has passed. That is never later than maximum_refresh_time, even if the server said the feed would keep longer.'),
+        make_option('--timeout', type='int', dest='timeout', default=None,
+            help='Give up on feeds not refreshed after this many seconds. Default: wait for all of them.'),
+        make_option('--force', action='store_true', dest='force', default=False,
+            help='Fetch every feed in full, ignoring validators and the minimum refresh time.'),
+    )
+
+    def handle(self, *args, **options):
+        feeds = self.select_feeds(args, options['only_due'])
+        refresher = FeedRefresher(concurrency=options['concurrency'], per_host=options['per_host'])
+        started = time.time()
+        refreshed = refresher.refresh(feeds, deadline=options['timeout'], force=options['force'])
+        if refreshed:
+            for aggr in Aggregate.objects.filter(feeds__feed__in=refreshed).distinct():
+                aggr.update_items()
+        self.report(feeds, refreshed, time.time() - started, int(options['verbosity']))
+
+    def select_feeds(self, args, only_due):
+        """Returns the feeds to refresh: the ones given by id, or all of them, limited to the due ones with --only-due."""
+        if only_due:
+            feeds = Feed.objects.due()
+        else:
+            feeds = Feed.objects.all()
+        if args:
+            try:
+                feeds = feeds.filter(pk__in=[int(arg) for arg in args])
+            except ValueError:
+                raise CommandError("Feed ids must be numbers.")
+        return list(feeds)
+
+    def report(self, feeds, refreshed, elapsed, verbosity):
+        """Writes a line per feed (at verbosity 1 and up), then the totals."""
+        counts = {}
+        total_bytes = 0
+        for feed in feeds:
+            if feed.id in refreshed or feed.outcome == 'error':
+                outcome = feed.outcome
+            else:
+                outcome = 'timed out'
+            counts[outcome] = counts.get(outcome, 0) + 1
+            total_bytes += feed.bytes_read
+            if verbosity >= 1:
+                seconds = feed.refresh_seconds or 0
+                line = u"%5d  %-12s %10d bytes %7.2fs  %s\n" % (feed.id, outcome, feed.bytes_read, seconds, feed.name)
+                self.stdout.write(line.encode('utf-8'))
+        rate = len(feeds) / elapsed if elapsed else 0
+        self.stdout.write("%d feeds in %.2fs (%.1f/s): %d fetched, %d not modified, %d skipped, %d busy, %d broken, %d errors, %d timed out; %d bytes\n" % (
+            len(feeds), elapsed, rate,
+            counts.get('fetched', 0), counts.get('not modified', 0), counts.get('skipped', 0),
+            counts.get('busy', 0), counts.get('broken', 0), counts.get('error', 0), counts.get('timed out', 0), total_bytes,
+        ))
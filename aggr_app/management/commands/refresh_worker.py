@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from aggr_app.models import Feed, Aggregate
+from aggr_app.refresh import FeedRefresher
+from optparse import make_option
+import time
+
+class Command(BaseCommand):
+    help = "Refreshes feeds in the background as they come due."
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+            help='Refresh the feeds that are due now, then exit.'),
+        make_option('--max-sleep', type='int', dest='max_sleep', default=60,
+            help='Longest time (in seconds) to sleep between checks. Default 60.'),
+        make_option('--concurrency', type='int', dest='concurrency', default=8,
+            help='Number of feeds to fetch at once. Default 8.'),
+        make_option('--per-host', type='int', dest='per_host', default=None,
+            help='Number of feeds to fetch at once from any one host. Default, and most, AGGR_HOST_MAX_REQUESTS.'),
+    )
+
+    def handle(self, *args, **options):
+        max_sleep = options['max_sleep']
+        refresher = FeedRefresher(concurrency=options['concurrency'], per_host=options['per_host'])
+        while True:
+            self.refresh_due(refresher)
+            if options['once']:
+                break
+            time.sleep(self.seconds_until_due(max_sleep))
+
+    def refresh_due(self, refresher):
+        """Refreshes every feed that is due; one bad feed won't stop the rest.
+
+        Aggregates using the refreshed feeds are brought up to date too,
+        so that page views don't have to.
+        """
+        refreshed = refresher.refresh(Feed.objects.due())
+        if refreshed:
+            for aggr in Aggregate.objects.filter(feeds__feed__in=refreshed).distinct():
+                aggr.update_items()
+
+    def seconds_until_due(self, max_sleep):
+        """Returns how long to sleep until the next feed is due."""
+        upcoming = Feed.objects.order_by('next_refresh').values_list('next_refresh', flat=True)[:1]
+        if not upcoming:
+            return max_sleep
+        delta = upcoming[0] - timezone.now()
+        seconds = delta.days * 86400 + delta.seconds
+        return min(max(seconds, 1), max_sleep)
@@ -1,21 +1,55 @@
-from django.db import models
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, transaction, IntegrityError
+from django.db.models import Q, Max
+from django.db.models.signals import post_save, post_delete
 import datetime
 import time
 from dateutil import parser
 from django.utils import timezone
 from picklefield.fields import PickledObjectField
+from aggr_app.filters import FilterSet, FilterError, compile_filter, compile_expression, is_expression
+from aggr_app import search
+from aggr_app import fetch
 import feedparser
-import urllib2
-import re
+import hashlib
+import heapq
+import itertools
+import calendar
 import logging
+import re
 
 logger = logging.getLogger(__name__)
 
-web_timestamp_format = "%a, %d %b %Y %H:%M:%S %Z"
-
-class HeadRequest(urllib2.Request):
-    def get_method(self):
-        return "HEAD"
+class FeedManager(models.Manager):
+    names_key = 'aggr_app.feed_names'
+    
+    def due(self, now=None):
+        """Returns the Feeds whose scheduled refresh time has passed.
+        
+        The most read come first, so a pool that can't keep up with all
+        of them keeps those fresh.
+        """
+        if now is None:
+            now = timezone.now()
+        return self.filter(next_refresh__lte=now).order_by('-priority', 'next_refresh')
+    
+    def names(self):
+        """Returns {id: name} of every Feed.
+        
+        Cached until a Feed is added, renamed or deleted, so forms can
+        offer the feeds without a query each time. With a per-process
+        cache other processes don't hear of the change; FeedField asks
+        the database about ids missing from the names.
+        """
+        names = cache.get(self.names_key)
+        if names is None:
+            names = dict(self.values_list('id', 'name'))
+            cache.set(self.names_key, names, 24 * 60 * 60)
+        return names
+    
+    def forget_names(self):
+        cache.delete(self.names_key)
 
 class Feed(models.Model):
     """Models RSS/Atom feeds; parses and caches their contents."""
@@ -23,136 +57,646 @@ class Feed(models.Model):
     url = models.URLField(max_length=400)
     last_updated = models.DateTimeField(auto_now_add=True)
     cache_expires = models.DateTimeField(auto_now_add=True)
-    supports_conditional_get = models.BooleanField(default=False)
+    next_refresh = models.DateTimeField(default=timezone.now, db_index=True)
+    # Bumped whenever a refresh stores new or changed entries.
+    version = models.IntegerField(default=0)
+    # Validators from the server's last 200, sent back on every refresh.
+    etag = models.CharField(max_length=400, blank=True)
+    last_modified = models.CharField(max_length=100, blank=True)
+    # SHA-1 of the last body fetched, for servers that send no validators.
+    body_hash = models.CharField(max_length=40, blank=True)
+    # Seconds between polls, estimated from the entries' publish times.
+    # 0 until there's enough history to estimate from.
+    refresh_interval = models.IntegerField(default=0)
+    # Refreshes in a row that found nothing new, and that failed.
+    unchanged_count = models.IntegerField(default=0)
+    error_count = models.IntegerField(default=0)
+    # Set while a refresh is in progress, so only one runs at a time
+    # across all processes; a crashed refresher's lease runs out.
+    lease_until = models.DateTimeField(null=True, blank=True)
+    # Set when the feed has failed too often in a row: until then it is
+    # not fetched at all, and its pages show what was last fetched.
+    circuit_open_until = models.DateTimeField(null=True, blank=True)
+    # Reads of the feed's page, counted by aggr_app.access. A new feed
+    # counts as just read.
+    read_count = models.IntegerField(default=0)
+    last_read = models.DateTimeField(default=timezone.now)
+    # HOT, WARM or COLD, by how recently the feed or an aggregate of it
+    # was read; see read_priority().
+    priority = models.IntegerField(default=1)
     cache = PickledObjectField()
     
+    HOT = 2
+    WARM = 1
+    COLD = 0
+    
     minimum_refresh_time = datetime.timedelta(seconds=120)
+    maximum_refresh_time = datetime.timedelta(days=1)
+    # The interval grows by this much for every refresh that finds nothing new.
+    backoff_factor = 1.5
+    # How many recent entries to estimate the posting rate from.
+    history_size = 20
+    # Bytes read from the network at a time.
+    chunk_size = 64 * 1024
+    
+    # What the last update_cache() call did: 'fetched', 'not modified',
+    # 'skipped' (too soon to ask again), 'busy' (being refreshed
+    # elsewhere, already refreshed since this was loaded, or its host
+    # has too many fetches in progress), 'broken'
+    # (its circuit is open) or 'error'; the size of the body
+    # read, and how long it all took. metrics holds the rest of what is
+    # recorded in its RefreshLog.
+    outcome = None
+    bytes_read = 0
+    refresh_seconds = None
+    metrics = {}
+    
+    objects = FeedManager()
     
     def __unicode__(self):
         return self.name
     
-    def check_conditional_support(self):
-        """Check if the URL supports conditional GET with If-Modified-Since."""
-        if not self.url:
-            return False
-        request = HeadRequest(self.url)
-        try:
-            response = urllib2.urlopen(request)
-        except urllib2.HTTPError as e:
-            logger.debug("Got %d from %s when trying to test conditional GET." % (e.code, self.url))
-            return False
-        last_modified = response.headers.get('Last-Modified')
-        if not last_modified:
-            # No Last-Modified header means no support for If-Modified-Since.
-            return False
+    def estimate_interval(self):
+        """Returns how often (in seconds) to poll, judging by recent entries.
         
-        request.add_header('If-Modified-Since', last_modified)
-        try:
-            response = urllib2.urlopen(request)
-        except urllib2.HTTPError as e:
-            if e.code == 304:
-                # 304 Not Modified. Supports conditional GET.
-                logger.debug("Conditional GET supported on %s." % (self.name))
-                return True
-            else:
-                # Some other error. Probably should do something about it,
-                # report it or something, but for now, do nothing.
-                logger.debug("Got %d from %s when trying to test conditional GET." % (e.code, self.url))
-                return False
+        A feed is polled about twice per gap between its posts.
+        """
+        times = list(self.entries.order_by('-published').values_list('published', flat=True)[:self.history_size])
+        if len(times) < 2:
+            return 0
+        gap = (times[0] - times[-1]).total_seconds() / (len(times) - 1)
+        return int(gap / 2)
+    
+    def schedule_refresh(self):
+        """Works out when the feed should next be refreshed and stores it.
+        
+        Starts from the estimated posting interval, then backs off
+        exponentially for each refresh in a row that failed, or more
+        gently for each that found nothing new. Hot feeds don't back off
+        past AGGR_HOT_MAX_INTERVAL for want of news, and cold ones are
+        only refreshed once every maximum_refresh_time. Never sooner
+        than the server's Expires/max-age/Retry-After allows (up to
+        maximum_refresh_time), or while the feed's circuit is open.
+        
+        Only the schedule columns are written, so the cache is not
+        re-pickled just to reschedule.
+        """
+        now = timezone.now()
+        minimum = self.minimum_refresh_time.total_seconds()
+        maximum = self.maximum_refresh_time.total_seconds()
+        self.priority = self.read_priority()
+        if self.error_count:
+            interval = minimum * 2 ** min(self.error_count, 16)
         else:
-            # Most likely got a 200 OK. Conditional GET is not supported.
-            logger.debug("Conditional GET *not* supported on %s." % (self.name))
-            return False
+            interval = max(self.refresh_interval, minimum) * self.backoff_factor ** min(self.unchanged_count, 32)
+            if self.priority == Feed.HOT:
+                interval = min(interval, getattr(settings, 'AGGR_HOT_MAX_INTERVAL', 60 * 60))
+        if self.priority == Feed.COLD:
+            interval = maximum
+        interval = min(max(interval, minimum), maximum)
+        # The server may ask for a longer wait than the maximum; check
+        # back at least that often all the same.
+        self.next_refresh = min(max(self.cache_expires, now + datetime.timedelta(seconds=interval)),
+                                now + self.maximum_refresh_time)
+        if self.circuit_open_until:
+            self.next_refresh = max(self.next_refresh, self.circuit_open_until)
+        Feed.objects.filter(pk=self.pk).update(
+            next_refresh=self.next_refresh,
+            cache_expires=self.cache_expires,
+            unchanged_count=self.unchanged_count,
+            error_count=self.error_count,
+            circuit_open_until=self.circuit_open_until,
+            priority=self.priority,
+        )
+    
+    def read_priority(self):
+        """Returns HOT, WARM or COLD: how recently the feed was last read.
+        
+        Reads of any aggregate the feed is in count too. HOT is within
+        AGGR_HOT_PERIOD seconds, WARM within AGGR_COLD_PERIOD.
+        """
+        # Reads are counted by other requests while the feed refreshes;
+        # go by what they've written, not by when this copy was loaded.
+        last_read = Feed.objects.filter(pk=self.pk).values_list('last_read', flat=True)[0]
+        aggregates_read = Aggregate.objects.filter(feeds__feed=self).aggregate(last=Max('last_read'))['last']
+        if aggregates_read and aggregates_read > last_read:
+            last_read = aggregates_read
+        age = timezone.now() - last_read
+        if age <= datetime.timedelta(seconds=getattr(settings, 'AGGR_HOT_PERIOD', 24 * 60 * 60)):
+            return Feed.HOT
+        if age <= datetime.timedelta(seconds=getattr(settings, 'AGGR_COLD_PERIOD', 14 * 24 * 60 * 60)):
+            return Feed.WARM
+        return Feed.COLD
+    
+    def circuit_open(self):
+        """Whether the feed has failed too often lately to be fetched."""
+        return self.circuit_open_until is not None and timezone.now() < self.circuit_open_until
+    
+    def update_circuit(self):
+        """Opens or closes the feed's circuit, going by its failures in a row.
+        
+        After AGGR_CIRCUIT_THRESHOLD failures the circuit opens for
+        AGGR_CIRCUIT_BASE seconds, and for twice as long after each
+        further failure, up to AGGR_CIRCUIT_MAX. Once it runs out, the
+        next refresh is a trial: success closes the circuit again.
+        """
+        threshold = getattr(settings, 'AGGR_CIRCUIT_THRESHOLD', 3)
+        if self.error_count < threshold:
+            self.circuit_open_until = None
+            return
+        base = getattr(settings, 'AGGR_CIRCUIT_BASE', 10 * 60)
+        maximum = getattr(settings, 'AGGR_CIRCUIT_MAX', 24 * 60 * 60)
+        seconds = min(base * 2 ** min(self.error_count - threshold, 16), maximum)
+        self.circuit_open_until = timezone.now() + datetime.timedelta(seconds=seconds)
     
     def update_cache(self, force=False):
         """Fetches and parses the feed if it has updated.
         
-        Uses a conditional GET (if supported) to retrieve an updated feed,
-        then parses it, updates the cache, and returns the parsed feed.
-        
-        If the URL does not support conditional GET, the Last-Modified
-        date will be checked first with a HEAD request.
+        Sends a conditional GET with the ETag and Last-Modified the
+        server gave us last time, so an unchanged feed costs a single
+        304. On a 200 the new and changed entries are stored, and the
+        cache updated if the feed's own data changed. A 200 with the same
+        body as last time is treated like a 304, without parsing it.
+        Fetches go through the shared, connection-pooling fetch.client.
         
         If force == True, do a full GET and update the cache regardless.
+        
+        A feed whose circuit is open (see update_circuit) isn't fetched
+        unless forced; its current cache is returned.
+        
+        Only one refresh of a feed runs at a time: if another process
+        or thread holds the feed's lease, this returns the current cache
+        straight away and leaves the refresh to it.
+        
+        If the feed's host already has as many fetches in progress as
+        fetch.client allows, the outcome is 'busy' too: the feed isn't
+        counted as failing, and stays due.
+        
+        Otherwise the next refresh is scheduled afterwards. outcome,
+        bytes_read and refresh_seconds say how it went, and unless it was
+        skipped, a RefreshLog is also kept.
+        This is called by the refresh_worker and refresh_feeds commands,
+        and in the background by views showing overdue feeds.
+        """
+        started = time.time()
+        self.outcome = 'busy'
+        self.bytes_read = 0
+        self.metrics = {}
+        self.refresh_seconds = 0
+        if not force and self.circuit_open():
+            self.outcome = 'broken'
+            logger.debug("%s:%d keeps failing; not trying again until %s." % (self.name, self.id, self.circuit_open_until))
+            return self.cache
+        if not self.acquire_lease():
+            logger.debug("%s:%d is being refreshed elsewhere." % (self.name, self.id))
+            return self.cache
+        self.outcome = 'skipped'
+        try:
+            return self._update_cache(force)
+        except Exception, e:
+            self.error_count += 1
+            self.outcome = 'error'
+            self.metrics['error'] = repr(e)
+            raise
+        finally:
+            if self.outcome != 'busy':
+                if self.outcome != 'skipped':
+                    self.update_circuit()
+                self.schedule_refresh()
+            self.release_lease()
+            self.refresh_seconds = time.time() - started
+            if self.outcome not in ('skipped', 'busy'):
+                RefreshLog.objects.record(self)
+    
+    def lease_time(self):
+        return datetime.timedelta(seconds=getattr(settings, 'AGGR_REFRESH_LEASE', 5 * 60))
+    
+    def acquire_lease(self):
+        """Takes the right to refresh the feed; returns False if it can't.
+        
+        Fails if another refresher holds an unexpired lease, or if the
+        feed has been rescheduled since this instance was loaded, which
+        means someone else has just refreshed it.
         """
+        now = timezone.now()
+        until = now + self.lease_time()
+        free = Q(lease_until__isnull=True) | Q(lease_until__lt=now)
+        taken = Feed.objects.filter(free, pk=self.pk, next_refresh=self.next_refresh).update(lease_until=until)
+        if taken:
+            self.lease_until = until
+        return bool(taken)
+    
+    def release_lease(self):
+        """Gives the lease up, unless it ran out and someone else has taken it."""
+        Feed.objects.filter(pk=self.pk, lease_until=self.lease_until).update(lease_until=None)
+        self.lease_until = None
+    
+    def _update_cache(self, force):
         logger.debug("Updating cache of %s:%d." % (self.name, self.id))
         
-        if force or not self.cache:
-            # Force a full GET request.
-            if not self.cache:
-                # First time accessing the URL, see if it supports conditional GET.
-                self.supports_conditional_get = self.check_conditional_support()
-            request = urllib2.Request(self.url)
-        elif timezone.now() < self.last_updated + self.minimum_refresh_time:
-            logger.debug("Not updating, minimum refresh time not passed.")
-            return self.cache
-        elif self.supports_conditional_get:
-            # Set up a conditional GET request.
-            request = urllib2.Request(self.url, headers={'If-Modified-Since': self.last_updated.strftime(web_timestamp_format)})
-        else:
-            # First send a HEAD request to check Last-Modified header.
-            head_request = HeadRequest(self.url)
-            try:
-                response = urllib2.urlopen(head_request)
-            except urllib2.HTTPError as e:
-                logger.debug("Error %d response when sending HEAD request for %s." % (e.code, self.name))
-                return self.cache
-            last_modified = last_modified = parser.parse(response.headers.setdefault('Last-Modified', str(timezone.now())))
-            if last_modified <= self.last_updated:
-                # No update since last check. Return old cache.
-                logger.debug("HEAD request indicates no change.")
+        headers = {}
+        if self.cache and not force:
+            if timezone.now() < self.last_updated + self.minimum_refresh_time:
+                logger.debug("Not updating, minimum refresh time not passed.")
                 return self.cache
-            request = urllib2.Request(self.url)
-        
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+        try:
+            response = fetch.client.get(self.url, headers)
+        except fetch.HostBusy:
+            # Not the feed's fault; leave it due, to be tried again soon.
+            logger.debug("%s is busy; not refreshing %s:%d now." % (self.url, self.name, self.id))
+            self.outcome = 'busy'
+            return self.cache
+        self.metrics['status'] = response.status
         try:
-            response = urllib2.urlopen(request)
-        except urllib2.HTTPError as e:
-            if e.code == 304:
+            if response.status == 304:
                 # Feed hasn't updated since we last hit it; return old cache.
+                # The server may still have moved the expiry time on.
+                logger.debug("Not modified.")
+                self.outcome = 'not modified'
+                self.cache_expires = self.expiry_time(response.headers)
+                self.unchanged_count += 1
+                self.error_count = 0
                 return self.cache
-            else:
-                # Some other error. Probably should do something about it,
-                # report it or something, but for now, do nothing.
-                logger.debug("Got %d from %s when trying to update cache." % (e.code, self.url))
+            elif response.status >= 400:
+                # Some error; back off, for as long as the server asks if it does.
+                logger.debug("Got %d from %s when trying to update cache." % (response.status, self.url))
+                self.error_count += 1
+                self.outcome = 'error'
+                if response.headers.get('Retry-After'):
+                    self.cache_expires = self.retry_time(response.headers.get('Retry-After'))
                 return self.cache
+            elif response.status != 200:
+                logger.debug("Cache not updating, code %d, url %s" % (response.status, self.url))
+                return self.cache
+            body = self.read_body(response)
+        finally:
+            response.close()
+            self.metrics.update(response.timings)
+            self.metrics['bytes_received'] = response.bytes_received
+        self.outcome = 'fetched'
+        self.bytes_read = len(body)
+        body_hash = hashlib.sha1(body).hexdigest()
+        if body_hash == self.body_hash and self.cache and not force:
+            # The server sent the same bytes again; as good as a 304.
+            logger.debug("Body unchanged.")
+            self.outcome = 'not modified'
+            self.cache_expires = self.expiry_time(response.headers)
+            self.unchanged_count += 1
+            self.error_count = 0
+            return self.cache
+        self.body_hash = body_hash
         
         # Feed has been successfully downloaded.
-        if response.getcode() == 200:
-            logger.debug("Cache will be updated.")
-            last_modified = response.headers.get('Last-Modified')
-            #if last_modified:
-            #    self.last_updated = parser.parse(last_modified)
-            #else:
-            #    self.last_updated = timezone.now()
-            
-            # last_updated needs to be the actual update time so that minimum_refresh_time works
-            self.last_updated = timezone.now()
-            logger.debug("New Last-Modified=%s" % (last_modified))
-            logger.debug("Setting last_updated=%s" % (self.last_updated))
-            
-            if response.headers.get('Expires'):
-                self.cache_expires = parser.parse(response.headers.get('Expires'))
-            else:
-                # No explicit Expires header;
-                # check for age limits in Cache-Control.
-                # This needs more thought and a closer look.
-                cache_control = response.headers.get('Cache-Control')
-                if cache_control and cache_control.find("max-age="):
-                    start_index = cache_control.find("max-age=")
-                    end_index = cache_control.find(",", start_index)
-                    if end_index == -1:
-                        end_index = len(cache_control)
-                    max_age = int(cache_control[start_index+8:end_index])
-                    self.cache_expires = self.last_updated + datetime.timedelta(seconds=max_age)
-                else:
-                    self.cache_expires = timezone.now() + self.minimum_refresh_time
-            logger.debug("Setting cache_expires=%s" % (self.cache_expires))
-            self.cache = feedparser.parse(response.read())
-            self.save()
+        logger.debug("Cache will be updated.")
+        # last_updated needs to be the actual update time so that minimum_refresh_time works
+        self.last_updated = timezone.now()
+        self.etag = response.headers.get('ETag', '')
+        self.last_modified = response.headers.get('Last-Modified', '')
+        logger.debug("New ETag=%s, Last-Modified=%s" % (self.etag, self.last_modified))
+        logger.debug("Setting last_updated=%s" % (self.last_updated))
+        
+        self.cache_expires = self.expiry_time(response.headers)
+        logger.debug("Setting cache_expires=%s" % (self.cache_expires))
+        started = time.time()
+        parsed = feedparser.parse(body)
+        self.metrics['parse'] = time.time() - started
+        max_entries = getattr(settings, 'AGGR_MAX_FEED_ENTRIES', 500)
+        started = time.time()
+        (added, changed) = Entry.objects.ingest(self, parsed.entries[:max_entries])
+        self.metrics['store'] = time.time() - started
+        self.metrics['entries_added'] = added
+        self.metrics['entries_changed'] = changed
+        logger.debug("Stored %d new entries and %d changed ones." % (added, changed))
+        self.error_count = 0
+        if added or changed:
+            self.version += 1
+            self.unchanged_count = 0
+            self.refresh_interval = self.estimate_interval()
         else:
-            # Some kind of redirect? Write a debug message.
-            logger.debug("Cache not updating, code %d, url %s" % (response.getcode(), self.url))
+            self.unchanged_count += 1
+        started = time.time()
+        # Only write what a refresh owns: a full save() would put back
+        # the read counts and priority aggr_app.access has moved since
+        # this feed was loaded.
+        columns = dict(
+            last_updated=self.last_updated,
+            etag=self.etag,
+            last_modified=self.last_modified,
+            body_hash=self.body_hash,
+            version=self.version,
+            refresh_interval=self.refresh_interval,
+        )
+        if not (self.cache and self.cache.get('feed') == parsed.get('feed')):
+            # The entries live in their own table now; only keep the
+            # feed-level data (title, etc.) in the cache. The exception
+            # feedparser keeps for malformed feeds can't be pickled.
+            # Unchanged feed data isn't pickled again.
+            parsed['entries'] = []
+            parsed.pop('bozo_exception', None)
+            self.cache = parsed
+            columns['cache'] = parsed
+        Feed.objects.filter(pk=self.pk).update(**columns)
+        # Mostly pickling the cache, if it changed.
+        self.metrics['save'] = time.time() - started
         return self.cache
+    
+    def read_body(self, response):
+        """Reads a response body in chunks, up to AGGR_MAX_FEED_BYTES.
+        
+        Anything past the limit is left unread. Feeds list their newest
+        entries first and feedparser copes with a truncated document, so
+        the start of an oversized feed is still worth parsing.
+        """
+        limit = getattr(settings, 'AGGR_MAX_FEED_BYTES', 4 * 1024 * 1024)
+        chunks = []
+        size = 0
+        while size < limit:
+            chunk = response.read(min(self.chunk_size, limit - size))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        else:
+            if response.read(1):
+                logger.warning("%s is over %d bytes; only the start was parsed." % (self.url, limit))
+        return ''.join(chunks)
+    
+    def expiry_time(self, headers):
+        """Returns when a response with the given headers goes stale."""
+        now = timezone.now()
+        if headers.get('Expires'):
+            # Expires: 0 and other junk mean "already expired".
+            return http_datetime(headers.get('Expires'), now)
+        # No explicit Expires header;
+        # check for age limits in Cache-Control.
+        cache_control = headers.get('Cache-Control', '')
+        if "max-age=" in cache_control:
+            start_index = cache_control.find("max-age=")
+            end_index = cache_control.find(",", start_index)
+            if end_index == -1:
+                end_index = len(cache_control)
+            try:
+                max_age = int(cache_control[start_index+8:end_index])
+            except ValueError:
+                max_age = 0
+            return now + datetime.timedelta(seconds=max_age)
+        return now + self.minimum_refresh_time
+    
+    def retry_time(self, retry_after):
+        """Returns the time a Retry-After header (seconds or a date) points to."""
+        try:
+            return timezone.now() + datetime.timedelta(seconds=int(retry_after))
+        except ValueError:
+            pass
+        return http_datetime(retry_after, timezone.now())
+
+def http_datetime(value, default):
+    """Parses a date from an HTTP header as an aware datetime, or returns default.
+    
+    A date without a zone is taken to be in UTC, as HTTP dates are.
+    """
+    try:
+        parsed = parser.parse(value)
+    except (ValueError, OverflowError):
+        return default
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, timezone.utc)
+    return parsed
+
+def entry_key(entry):
+    """Returns a hash identifying a feedparser entry.
+    
+    The id (guid) is used if there is one, then the link, and failing
+    both a hash of the content. The key doesn't depend on the feed, so
+    the same story syndicated by two feeds gets the same key.
+    """
+    ident = (entry.get('id') or entry.get('link') or u'').strip()
+    if not ident:
+        ident = u"\n".join((entry.get('title', u''), entry.get('summary', u'')))
+    return hashlib.sha1(ident.encode('utf-8')).hexdigest()
+
+def entry_terms(entry):
+    """Returns the tags (categories) of a feedparser entry, lowercased."""
+    terms = set()
+    for tag in entry.get('tags') or []:
+        term = (tag.get('term') or u'').strip().lower()[:100]
+        if term:
+            terms.add(term)
+    return terms
+
+def entry_content(entry):
+    """Returns the fields to store for a feedparser entry, with a hash of them and its tags."""
+    content = {
+        'title': entry.get('title', u''),
+        'link': entry.get('link', u''),
+        'summary': entry.get('summary', u''),
+        'author': entry.get('author', u'')[:200],
+    }
+    digest = hashlib.sha1()
+    for value in (content['title'], content['link'], content['summary'], content['author']):
+        digest.update(value.encode('utf-8') + '\0')
+    digest.update(u"\0".join(sorted(entry_terms(entry))).encode('utf-8'))
+    content['content_hash'] = digest.hexdigest()
+    return content
+
+def format_cursor(published, id):
+    """Returns a URL-safe cursor for the position of an entry in newest-first order."""
+    micros = calendar.timegm(published.utctimetuple()) * 1000000 + published.microsecond
+    return "%d_%d" % (micros, id)
+
+def parse_cursor(cursor):
+    """Returns the (published, id) a cursor points at, or None if it's junk."""
+    try:
+        (micros, id) = [int(part) for part in cursor.split('_')]
+        published = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc) + datetime.timedelta(microseconds=micros)
+    except (AttributeError, ValueError, OverflowError):
+        return None
+    return (published, id)
+
+def entry_published(entry, default):
+    """Returns the entry's published (or updated) time as an aware datetime."""
+    parsed = entry.get('published_parsed') or entry.get('updated_parsed')
+    if not parsed:
+        return default
+    # feedparser normalizes these to UTC.
+    return datetime.datetime(*parsed[:6], tzinfo=timezone.utc)
+
+def newest_first(streams):
+    """Merges streams of rows that are each sorted newest first.
+    
+    Every row must start with (published, id). The merge is lazy, so
+    taking the first N rows of k streams costs O(N log k).
+    """
+    def decorated(stream):
+        # heapq.merge only merges ascending, so negate the sort key.
+        for row in stream:
+            published = row[0]
+            yield (-calendar.timegm(published.utctimetuple()), -published.microsecond, -row[1], row)
+    for decorated_row in heapq.merge(*[decorated(stream) for stream in streams]):
+        yield decorated_row[-1]
+
+class EntryManager(models.Manager):
+    # Keeps each INSERT under SQLite's limit on query parameters.
+    batch_size = 100
+    
+    def ingest(self, feed, entries):
+        """Stores the feedparser entries that are new or have changed.
+        
+        Entries are taken in document order (normally newest first) a
+        batch at a time, and compared with the stored ones by a hash of
+        their content; only new and changed entries are written, and
+        only they are matched against the aggregates' filters. Once a
+        whole batch turns out to be stored already and unchanged, the
+        rest are assumed to be too and aren't looked at. Each batch is
+        stored and matched in one transaction.
+        Returns the numbers of entries (added, changed).
+        """
+        added = 0
+        changed = 0
+        keys = set()
+        fetched = timezone.now()
+        entries = iter(entries)
+        while True:
+            batch = []
+            for entry in entries:
+                key = entry_key(entry)
+                if key not in keys:
+                    keys.add(key)
+                    batch.append((key, entry_content(entry), entry))
+                    if len(batch) == self.batch_size:
+                        break
+            if not batch:
+                break
+            stored = dict(
+                (key, (id, content_hash)) for (key, id, content_hash)
+                in self.filter(feed=feed, key__in=[key for (key, content, entry) in batch]).values_list('key', 'id', 'content_hash')
+            )
+            new = [(key, content, entry) for (key, content, entry) in batch if key not in stored]
+            edited = [(key, content, entry) for (key, content, entry) in batch
+                      if key in stored and stored[key][1] != content['content_hash']]
+            if not new and not edited:
+                break
+            for (key, content, entry) in new + edited:
+                content['search_text'] = search.search_text(content['title'], content['summary'])
+            # An entry stored but not matched would never be matched:
+            # the next refresh finds it unchanged.
+            with transaction.commit_on_success(using=self.db):
+                self.bulk_create([
+                    self.model(feed=feed, key=key, published=entry_published(entry, fetched), **content)
+                    for (key, content, entry) in new
+                ])
+                ids = dict((key, stored[key][0]) for (key, content, entry) in edited)
+                for (key, content, entry) in edited:
+                    self.filter(pk=ids[key]).update(**content)
+                EntryTag.objects.filter(entry__in=ids.values()).delete()
+                self._add_tags(feed, new + edited, ids)
+                Membership.objects.match(feed, [key for (key, content, entry) in new + edited])
+            added += len(new)
+            changed += len(edited)
+        return (added, changed)
+    
+    def _add_tags(self, feed, entries, ids):
+        """Stores the tags (categories) of newly stored feedparser entries.
+        
+        ids maps keys to Entry ids, where they're known.
+        """
+        terms = {}
+        for (key, content, entry) in entries:
+            for term in entry_terms(entry):
+                terms.setdefault(key, set()).add(term)
+        if not terms:
+            return
+        # bulk_create doesn't give back ids; look them up.
+        missing = [key for key in terms if key not in ids]
+        if missing:
+            ids = dict(ids)
+            ids.update(self.filter(feed=feed, key__in=missing).values_list('key', 'id'))
+        tags = [EntryTag(entry_id=ids[key], term=term) for key in terms for term in terms[key]]
+        for start in range(0, len(tags), self.batch_size):
+            EntryTag.objects.bulk_create(tags[start:start + self.batch_size])
+    
+    def page(self, feed_id, before=None, size=50):
+        """Returns (entries, next cursor) for a page of a feed's entries, newest first.
+        
+        before: a (published, id) cursor; only older entries are returned.
+        The next cursor is None on the last page.
+        """
+        entries = self.filter(feed=feed_id).defer('search_text').order_by('-published', '-id')
+        if before:
+            (published, id) = before
+            entries = entries.filter(Q(published__lt=published) | Q(published=published, id__lt=id))
+        entries = list(entries[:size + 1])
+        if len(entries) > size:
+            return (entries[:size], format_cursor(entries[size - 1].published, entries[size - 1].id))
+        return (entries, None)
+    
+    def newest(self, feed_id, fields=(), chunk=200, terms=None, query=None):
+        """Yields a feed's entries as value tuples, newest first.
+        
+        Each tuple is (published, id) followed by the given fields.
+        Rows are read a chunk at a time along the (feed, published, id)
+        index, so a caller that stops early doesn't load the rest.
+        
+        terms: if the full-text index can be used, only entries it finds
+        containing one of these strings (ignoring case) are yielded.
+        query: a Q object the entries must match.
+        """
+        entries = self.filter(feed=feed_id).order_by('-published', '-id')
+        if query is not None:
+            entries = entries.filter(query)
+        if terms:
+            restricted = search.restrict(entries, terms)
+            if restricted is not None:
+                entries = restricted
+        columns = ('published', 'id') + tuple(fields)
+        rows = list(entries.values_list(*columns)[:chunk])
+        while rows:
+            for row in rows:
+                yield row
+            if len(rows) < chunk:
+                return
+            (published, id) = rows[-1][:2]
+            older = entries.filter(Q(published__lt=published) | Q(published=published, id__lt=id))
+            rows = list(older.values_list(*columns)[:chunk])
+
+class Entry(models.Model):
+    """A single item from a Feed, stored the first time it's seen."""
+    feed = models.ForeignKey(Feed, related_name='entries')
+    key = models.CharField(max_length=40)
+    published = models.DateTimeField(db_index=True)
+    title = models.TextField(blank=True)
+    link = models.TextField(blank=True)
+    summary = models.TextField(blank=True)
+    author = models.CharField(max_length=200, blank=True, db_index=True)
+    # The title and summary as plain text, which filters are matched against.
+    search_text = models.TextField(blank=True, editable=False)
+    # SHA-1 of the content as last fetched; see entry_content().
+    content_hash = models.CharField(max_length=40, blank=True, editable=False)
+    
+    objects = EntryManager()
+    
+    class Meta:
+        unique_together = (('feed', 'key'),)
+        verbose_name_plural = 'entries'
+    
+    def __unicode__(self):
+        return self.title
+    
+    def save(self, *args, **kwargs):
+        self.search_text = search.search_text(self.title, self.summary)
+        super(Entry, self).save(*args, **kwargs)
+
+class EntryTag(models.Model):
+    """A tag (or category) of an Entry, lowercased."""
+    entry = models.ForeignKey(Entry, related_name='tags')
+    term = models.CharField(max_length=100, db_index=True)
+    
+    def __unicode__(self):
+        return self.term
 
 class FilteredFeed(models.Model):
     feed = models.ForeignKey(Feed)
@@ -162,54 +706,434 @@ class FilteredFeed(models.Model):
         return u"%s: %s" % (self.feed, self.re_filter)
     
     def compiled_filter(self):
-        return re.compile(self.re_filter)
+        """Returns the compiled regex, or the Expression if the filter is one."""
+        if is_expression(self.re_filter):
+            return compile_expression(self.re_filter)
+        return compile_filter(self.re_filter)
     
     def make_tuple(self):
-        return (self.feed.id, self.re_filter)
+        return (self.feed_id, self.re_filter)
     
     def matches_tuple(self, rhs):
-        return (self.feed.id == rhs[0] and self.re_filter == rhs[1])
+        return (self.feed_id == rhs[0] and self.re_filter == rhs[1])
 
 
 class Aggregate(models.Model):
     """Aggregates feeds into a unified, filtered aggregate feed."""
     name = models.CharField(max_length=100)
     feeds = models.ManyToManyField(FilteredFeed)
-    items = PickledObjectField(default=[])
+    # The filters the memberships were built from.
+    built_from = PickledObjectField(default={})
+    # Reads of the aggregate's page and RSS feed, counted by
+    # aggr_app.access. A new aggregate counts as just read.
+    read_count = models.IntegerField(default=0)
+    last_read = models.DateTimeField(default=timezone.now)
     
     def __unicode__(self):
         return self.name
     
-    # Deprecated, returns duplicates.
-    def get_unfiltered_items(self):
-        """Returns all items in the component feeds, sorted by published timestamp."""
-        feeds = [f.feed.update_cache() for f in self.feeds.all()]
-        # Add the feed name to each entry for annotation.
-        for feed in feeds:
-            for entry in feed.entries:
-                entry['feed'] = feed.feed
-        self.items = [e for f in feeds for e in f.entries]
-        self.items.sort(key=lambda e: e.get('published_parsed') or e.get('updated_parsed'))
-        return self.items
-    
-    def apply_filters(self):
-        """Compiles filters; returns matching entries."""
-        items = []
-        for feed in self.feeds.all():
-            if feed.re_filter == "":
-                items.extend((e for e in feed.feed.update_cache().entries if e not in items))
-            else:
-                compiled_re = feed.compiled_filter()
-                for entry in feed.feed.update_cache().entries:
-                    if compiled_re.search(entry.title) or compiled_re.search(entry.summary):
-                        if entry not in items:
-                            logger.debug("Adding %s" % entry.title)
-                            items.append(entry)
-        # Sort by descending published date.
-        self.items = sorted(items, key=lambda e: e.get('published_parsed') or e.get('updated_parsed'), reverse=True)
-        return self.items
+    def items(self):
+        """Returns (published, id, key) of the matching Entries, newest first."""
+        return list(self._items())
+    
+    def _items(self):
+        items = self.memberships.order_by('-published', '-entry').values_list('published', 'entry', 'key')
+        # Entries were matched when they were stored; those that have
+        # aged out of their filters' windows since aren't listed.
+        filters = (self.built_from or {}).get('filters', ())
+        now = timezone.now()
+        for (window, feed_ids) in filter_windows(filters).items():
+            items = items.exclude(entry__feed__in=feed_ids, published__lte=now - window)
+        return items
+    
+    def _load(self, items):
+        """Returns the Entries for a run of items, keeping their order."""
+        ids = [item[1] for item in items]
+        # search_text is only for filtering.
+        entries = Entry.objects.defer('search_text').in_bulk(ids)
+        # Entries of deleted feeds may have gone since the items were built.
+        return [entries[i] for i in ids if i in entries]
+    
+    def get_items(self, limit=None, since=None):
+        """Returns the matching Entries, newest first.
+        
+        since: a datetime; only entries published after it are returned.
+        """
+        items = self._items()
+        if since is not None:
+            items = items.filter(published__gt=since)
+        return self._load(items[:limit])
+    
+    def page(self, before=None, size=50):
+        """Returns (entries, next cursor) for a page of the matching entries.
+        
+        before: a (published, id) cursor; only older entries are returned.
+        The page is read off the (aggregate, published, entry) index and
+        only its Entries are loaded. The next cursor is None on the last
+        page.
+        """
+        items = self._items()
+        if before:
+            (published, id) = before
+            items = items.filter(Q(published__lt=published) | Q(published=published, entry__lt=id))
+        items = list(items[:size + 1])
+        next_cursor = None
+        if len(items) > size:
+            items = items[:size]
+            next_cursor = format_cursor(*items[-1][:2])
+        return (self._load(items), next_cursor)
+    
+    def iter_items(self, filters=None):
+        """Yields (published, id, key) of matching entries, newest first.
+        
+        All the filters on one feed are tested together, so each entry
+        is read and examined once. Each feed's entries are read newest
+        first and the feeds are merged lazily, so only as many rows are
+        loaded as are consumed. Unfiltered feeds never load their text,
+        and expression filters are left to the database.
+        
+        Entries outside a filter's window (date>7d) now aren't yielded;
+        _items() leaves out those that age out of it later.
+        """
+        if filters is None:
+            filters = self.feeds.values_list('feed', 're_filter')
+        # Entry keys already yielded; entries sharing a key are the same story.
+        seen = set()
+        streams = []
+        for (feed_id, filter_set) in filter_sets(filters).items():
+            if filter_set.match_all:
+                streams.append(Entry.objects.newest(feed_id, ('key',)))
+                continue
+            if filter_set.expressions:
+                streams.append(Entry.objects.newest(feed_id, ('key',), query=filter_set.query()))
+            if filter_set.regexes:
+                streams.append(self._matching_entries(feed_id, filter_set, seen))
+        for item in newest_first(streams):
+            if item[2] not in seen:
+                seen.add(item[2])
+                yield item
+    
+    def _matching_entries(self, feed_id, filter_set, seen):
+        """Yields (published, id, key) of a feed's entries that pass the filters.
+        
+        Literal filters only read the entries the full-text index finds.
+        """
+        rows = Entry.objects.newest(feed_id, ('key', 'search_text'), terms=filter_set.terms)
+        for (published, id, key, text) in rows:
+            if key in seen:
+                continue
+            if filter_set.matches(*text.split(u'\n', 1)):
+                yield (published, id, key)
+    
+    def apply_filters(self, limit=None, filters=None):
+        """Compiles filters; stores and returns the matching entries.
+        
+        Only stored entries are read; feeds that have not been fetched
+        yet contribute nothing. With a limit, only the newest that many
+        entries are found, without reading the rest. The aggregate's
+        memberships are replaced with the matches.
+        """
+        items = list(itertools.islice(self.iter_items(filters), limit))
+        Membership.objects.replace(self, items)
+        return items
+    
+    def update_items(self):
+        """Rebuilds the memberships if the filters have changed, storing what they were built from.
+        
+        Entries are matched against the filters as they're stored (see
+        Membership.objects.match), so as long as the filters are what
+        the memberships were built from, this is one query. Returns True
+        if the memberships were rebuilt, and keeps a RebuildLog when
+        they are.
+        """
+        started = time.time()
+        filters = sorted(set(self.feeds.values_list('feed', 're_filter')))
+        # Aggregates built before memberships also have 'versions' here,
+        # so they get rebuilt once.
+        built_from = {'filters': filters}
+        if self.built_from == built_from:
+            return False
+        
+        filter_started = time.time()
+        items = self.apply_filters(filters=filters)
+        filter_time = time.time() - filter_started
+        self.built_from = built_from
+        save_started = time.time()
+        # Only the column a rebuild owns: a full save() would put back a
+        # name or read counts changed while the rebuild ran.
+        Aggregate.objects.filter(pk=self.pk).update(built_from=built_from)
+        RebuildLog.objects.record(
+            self,
+            kind='full',
+            items=len(items),
+            items_added=len(items),
+            filter_time=filter_time,
+            save_time=time.time() - save_started,
+            total_time=time.time() - started,
+        )
+        return True
     
     def feed_tuple(self):
         """Returns a tuple of 2-tuples of feed id and filter string."""
-        return tuple(feed.make_tuple() for feed in self.feeds.all())
+        return tuple(self.feeds.values_list('feed', 're_filter'))
+
+def filter_sets(filters):
+    """Maps feed id to a FilterSet of all the (feed id, filter) pairs' filters on it.
+    
+    Feeds with a filter that doesn't compile are left out.
+    """
+    patterns = {}
+    for (feed_id, re_filter) in filters:
+        patterns.setdefault(feed_id, []).append(re_filter)
+    compiled = {}
+    for (feed_id, p) in patterns.items():
+        try:
+            compiled[feed_id] = FilterSet(p)
+        except (re.error, FilterError), e:
+            logger.warning("Ignoring the filters on feed %d; they are invalid: %s" % (feed_id, e))
+    return compiled
+
+def filter_windows(filters):
+    """Maps each window (date>7d) of (feed id, filter) pairs to the ids of the feeds it limits."""
+    windows = {}
+    for (feed_id, filter_set) in filter_sets(filters).items():
+        if filter_set.window:
+            windows.setdefault(filter_set.window, []).append(feed_id)
+    return windows
+
+class MembershipManager(models.Manager):
+    # Keeps each INSERT under SQLite's limit on query parameters.
+    batch_size = 100
+    
+    def match(self, feed, keys):
+        """Records which aggregates the feed's entries with these keys belong to.
+        
+        Called as entries are stored: each one is tested once against
+        every filter on the feed, whichever aggregates they're in.
+        Entries already matched (ones that have changed) are tested
+        again. An entry whose key an aggregate already has, from another
+        feed carrying the same story, isn't added to it. Aggregates with
+        a filter that doesn't compile are skipped.
+        Returns the number of memberships added.
+        """
+        return self._atomically(self._match, feed, keys)
+    
+    def _match(self, feed, keys):
+        patterns = {}
+        for (aggregate_id, re_filter) in FilteredFeed.objects.filter(feed=feed).values_list('aggregate', 're_filter'):
+            if aggregate_id is not None:
+                patterns.setdefault(aggregate_id, []).append(re_filter)
+        if not patterns or not keys:
+            return 0
+        rows = list(
+            Entry.objects.filter(feed=feed, key__in=keys).order_by('-published', '-id')
+            .values_list('published', 'id', 'key', 'search_text')
+        )
+        ids = [id for (published, id, key, text) in rows]
+        self.filter(entry__in=ids).delete()
+        memberships = []
+        for (aggregate_id, filters) in patterns.items():
+            try:
+                filter_set = FilterSet(filters)
+            except (re.error, FilterError), e:
+                # Say, a filter saved through the admin, which doesn't
+                # check them. It mustn't keep the feed's other
+                # aggregates from their entries.
+                logger.warning("Not matching entries for aggregate %d; its filters are invalid: %s" % (aggregate_id, e))
+                continue
+            matched = set()
+            query = filter_set.query()
+            if query is not None:
+                matched.update(Entry.objects.filter(query, id__in=ids).values_list('id', flat=True))
+            taken = set(self.filter(aggregate=aggregate_id, key__in=keys).values_list('key', flat=True))
+            for (published, id, key, text) in rows:
+                if key not in taken and (id in matched or filter_set.matches(*text.split(u'\n', 1))):
+                    taken.add(key)
+                    memberships.append(self.model(aggregate_id=aggregate_id, entry_id=id, published=published, key=key))
+        self._insert(memberships)
+        return len(memberships)
+    
+    def aged_out(self, aggregate_id, windows, now):
+        """Returns the newest publish time of the aggregate's entries that have left their windows.
+        
+        windows is as filter_windows() returns. None if there are none.
+        """
+        latest = None
+        for (window, feed_ids) in windows.items():
+            published = self.filter(
+                aggregate=aggregate_id, entry__feed__in=feed_ids, published__lte=now - window
+            ).aggregate(last=Max('published'))['last']
+            if published is not None and (latest is None or published > latest):
+                latest = published
+        return latest
+    
+    def replace(self, aggregate, items):
+        """Makes the (published, id, key) items the aggregate's only memberships."""
+        self._atomically(self._replace, aggregate, items)
+    
+    def _replace(self, aggregate, items):
+        self.filter(aggregate=aggregate).delete()
+        self._insert([
+            self.model(aggregate=aggregate, entry_id=id, published=published, key=key)
+            for (published, id, key) in items
+        ])
+    
+    def _atomically(self, function, *args):
+        """Calls function in a transaction, and once more if it collides with another writer.
+        
+        A rebuild and an ingest (or two of either) may write an
+        aggregate's memberships at once. Each deletes and inserts in one
+        transaction, and the unique constraints stop a story going in
+        twice; the loser tries again, seeing the winner's rows. Called
+        inside a transaction already, as ingest does, only the work since
+        a savepoint is undone for the retry.
+        """
+        with transaction.commit_on_success(using=self.db):
+            for attempt in range(2):
+                savepoint = transaction.savepoint(using=self.db)
+                try:
+                    result = function(*args)
+                except IntegrityError:
+                    transaction.savepoint_rollback(savepoint, using=self.db)
+                    if attempt:
+                        raise
+                    logger.debug("Memberships were written concurrently; trying again.")
+                else:
+                    transaction.savepoint_commit(savepoint, using=self.db)
+                    return result
+    
+    def _insert(self, memberships):
+        for start in range(0, len(memberships), self.batch_size):
+            self.bulk_create(memberships[start:start + self.batch_size])
+
+class Membership(models.Model):
+    """Says an Entry passed an Aggregate's filters.
+    
+    published and key are copied from the Entry, so an aggregate's
+    page can be read off an index without joining to the entries.
+    """
+    aggregate = models.ForeignKey(Aggregate, related_name='memberships')
+    entry = models.ForeignKey(Entry, related_name='memberships')
+    published = models.DateTimeField()
+    key = models.CharField(max_length=40)
+    
+    objects = MembershipManager()
+    
+    class Meta:
+        unique_together = (('aggregate', 'entry'), ('aggregate', 'key'))
+    
+    def __unicode__(self):
+        return u"%s in %s" % (self.entry_id, self.aggregate_id)
+
+
+class LogManager(models.Manager):
+    def recent(self):
+        return self.order_by('-started', '-id')
+    
+    def prune(self, **owner):
+        """Deletes all but the newest AGGR_METRICS_HISTORY logs of a feed or aggregate."""
+        history = getattr(settings, 'AGGR_METRICS_HISTORY', 100)
+        logs = self.filter(**owner).order_by('-id').values_list('id', flat=True)
+        oldest_kept = list(logs[history - 1:history])
+        if oldest_kept:
+            self.filter(id__lt=oldest_kept[0], **owner).delete()
+
+class RefreshLogManager(LogManager):
+    def record(self, feed):
+        """Stores the metrics of the feed's last update_cache() call."""
+        if not getattr(settings, 'AGGR_METRICS_HISTORY', 100):
+            return None
+        metrics = feed.metrics
+        log = self.create(
+            feed=feed,
+            started=timezone.now() - datetime.timedelta(seconds=feed.refresh_seconds),
+            outcome=feed.outcome,
+            status=metrics.get('status'),
+            dns_time=metrics.get('dns', 0),
+            connect_time=metrics.get('connect', 0),
+            wait_time=metrics.get('wait', 0),
+            transfer_time=metrics.get('transfer', 0),
+            parse_time=metrics.get('parse', 0),
+            store_time=metrics.get('store', 0),
+            save_time=metrics.get('save', 0),
+            total_time=feed.refresh_seconds,
+            bytes_received=metrics.get('bytes_received', 0),
+            bytes_read=feed.bytes_read,
+            entries_added=metrics.get('entries_added', 0),
+            entries_changed=metrics.get('entries_changed', 0),
+            error=metrics.get('error', u''),
+        )
+        self.prune(feed=feed)
+        return log
+
+class RefreshLog(models.Model):
+    """Timings and counters from one refresh of a Feed. Times are in seconds."""
+    feed = models.ForeignKey(Feed, related_name='refresh_logs')
+    started = models.DateTimeField(db_index=True)
+    # As Feed.outcome: 'fetched', 'not modified' or 'error'.
+    outcome = models.CharField(max_length=20)
+    status = models.IntegerField(null=True)
+    dns_time = models.FloatField(default=0)
+    connect_time = models.FloatField(default=0)
+    # From sending the request until the response headers arrive.
+    wait_time = models.FloatField(default=0)
+    transfer_time = models.FloatField(default=0)
+    parse_time = models.FloatField(default=0)
+    # Storing the new entries.
+    store_time = models.FloatField(default=0)
+    # Saving the Feed, mostly pickling its cache.
+    save_time = models.FloatField(default=0)
+    total_time = models.FloatField(default=0)
+    # The body as sent (maybe compressed), and as parsed.
+    bytes_received = models.IntegerField(default=0)
+    bytes_read = models.IntegerField(default=0)
+    entries_added = models.IntegerField(default=0)
+    entries_changed = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    
+    objects = RefreshLogManager()
+    
+    def __unicode__(self):
+        return u"%s at %s: %s" % (self.feed, self.started, self.outcome)
+
+class RebuildLogManager(LogManager):
+    def record(self, aggregate, **metrics):
+        """Stores the metrics of one rebuild of an aggregate's items."""
+        if not getattr(settings, 'AGGR_METRICS_HISTORY', 100):
+            return None
+        started = timezone.now() - datetime.timedelta(seconds=metrics['total_time'])
+        log = self.create(aggregate=aggregate, started=started, **metrics)
+        self.prune(aggregate=aggregate)
+        return log
+
+class RebuildLog(models.Model):
+    """Timings and counters from one rebuild of an Aggregate's items. Times are in seconds."""
+    aggregate = models.ForeignKey(Aggregate, related_name='rebuild_logs')
+    started = models.DateTimeField(db_index=True)
+    # 'full' when the filters changed. New entries are matched as they're
+    # stored; older logs may also say 'merge', for entries merged in later.
+    kind = models.CharField(max_length=10)
+    items = models.IntegerField(default=0)
+    items_added = models.IntegerField(default=0)
+    filter_time = models.FloatField(default=0)
+    # Saving the Aggregate; the memberships are written during filter_time.
+    save_time = models.FloatField(default=0)
+    total_time = models.FloatField(default=0)
+    
+    objects = RebuildLogManager()
+    
+    def __unicode__(self):
+        return u"%s at %s: %s" % (self.aggregate, self.started, self.kind)
+
+
+def feed_saved(sender, instance, created, **kwargs):
+    # Only a new or renamed feed changes the names.
+    names = cache.get(Feed.objects.names_key)
+    if names is not None and (created or names.get(instance.id) != instance.name):
+        Feed.objects.forget_names()
+
+def feed_deleted(sender, instance, **kwargs):
+    Feed.objects.forget_names()
 
+post_save.connect(feed_saved, sender=Feed)
+post_delete.connect(feed_deleted, sender=Feed)
@@ -0,0 +1,176 @@
+"""Refreshes many feeds at once with a bounded pool of threads."""
+from django.db import connection
+from aggr_app import fetch
+from aggr_app.models import Feed, Aggregate
+import threading
+import urlparse
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+def feed_host(feed):
+    """Returns the host a feed is fetched from, for per-host limits."""
+    return urlparse.urlparse(feed.url).netloc.lower()
+
+class FeedRefresher(object):
+    """Refreshes feeds concurrently.
+
+    concurrency: the number of worker threads.
+    per_host: the most fetches allowed against any one host at once.
+    Defaults to, and can't be more than, what fetch.client allows
+    (AGGR_HOST_MAX_REQUESTS).
+    """
+    def __init__(self, concurrency=8, per_host=None):
+        self.concurrency = concurrency
+        self.per_host = min(per_host or fetch.client.per_host, fetch.client.per_host)
+
+    def refresh(self, feeds, deadline=None, force=False):
+        """Refreshes the given feeds; returns the ids of the ones that finished.
+
+        deadline: seconds to wait for the whole batch. Feeds that haven't
+        been refreshed by then are left alone and keep their stale cache;
+        a fetch already in progress is allowed to finish in the background.
+        """
+        run = _RefreshRun(list(feeds), self.per_host, force)
+        if not run.pending:
+            return set()
+        workers = []
+        for i in range(min(self.concurrency, len(run.pending))):
+            worker = threading.Thread(target=run.work, name="feed-refresh-%d" % i)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        stop_at = deadline is not None and time.time() + deadline
+        for worker in workers:
+            if stop_at:
+                worker.join(max(stop_at - time.time(), 0))
+            else:
+                worker.join()
+        with run.lock:
+            run.cancelled = True
+            run.lock.notify_all()
+            if run.pending:
+                logger.debug("Deadline passed with %d feeds not refreshed." % len(run.pending))
+            return set(run.finished)
+
+class Revalidator(object):
+    """Refreshes feeds in the background for views serving stale pages.
+
+    However many requests find a feed overdue, it is only queued once
+    until its refresh is over; the feed's lease keeps other processes
+    from refreshing it at the same time.
+
+    The queue is drained by up to workers threads, each refreshing all
+    the feeds waiting at once. At most max_queued feeds are waiting or
+    being refreshed; more are left to refresh_worker, or to whichever
+    request finds them overdue once there's room.
+    """
+    def __init__(self, refresher=None, workers=1, max_queued=100):
+        self.refresher = refresher or FeedRefresher(concurrency=2, per_host=1)
+        self.workers = workers
+        self.max_queued = max_queued
+        # Feeds waiting for a worker, and those waiting or being refreshed.
+        self.waiting = set()
+        self.queued = set()
+        self.threads = 0
+        self.ready = threading.Condition()
+
+    def revalidate(self, feed_ids):
+        """Queues whichever of the feeds aren't queued already, while there's room.
+
+        Returns the ids that were queued by this call.
+        """
+        with self.ready:
+            new = set(feed_ids) - self.queued
+            room = max(self.max_queued - len(self.queued), 0)
+            if len(new) > room:
+                logger.debug("Revalidation queue is full; not queueing %d feeds." % (len(new) - room))
+                new = set(sorted(new)[:room])
+            if new:
+                self.queued |= new
+                self.waiting |= new
+                self.ready.notify()
+                if self.threads < self.workers:
+                    self.threads += 1
+                    thread = threading.Thread(target=self.work, name="feed-revalidate")
+                    thread.daemon = True
+                    thread.start()
+        return new
+
+    def work(self):
+        while True:
+            with self.ready:
+                while not self.waiting:
+                    self.ready.wait()
+                feed_ids = self.waiting
+                self.waiting = set()
+            self.run(feed_ids)
+
+    def run(self, feed_ids):
+        try:
+            refreshed = self.refresher.refresh(Feed.objects.filter(pk__in=feed_ids))
+            if refreshed:
+                for aggr in Aggregate.objects.filter(feeds__feed__in=refreshed).distinct():
+                    aggr.update_items()
+        except Exception:
+            logger.exception("Revalidating feeds %s failed." % sorted(feed_ids))
+        finally:
+            with self.ready:
+                self.queued -= feed_ids
+            connection.close()
+
+revalidator = Revalidator()
+
+class _RefreshRun(object):
+    """The shared state of one FeedRefresher.refresh() call."""
+    def __init__(self, feeds, per_host, force):
+        self.pending = feeds
+        self.per_host = per_host
+        self.force = force
+        self.active = {}
+        self.finished = []
+        self.cancelled = False
+        self.lock = threading.Condition()
+
+    def next_feed(self):
+        """Takes the next feed whose host isn't at its limit, waiting if need be.
+
+        Returns None when there is nothing left to do.
+        """
+        with self.lock:
+            while self.pending and not self.cancelled:
+                for i, feed in enumerate(self.pending):
+                    host = feed_host(feed)
+                    if self.active.get(host, 0) < self.per_host:
+                        del self.pending[i]
+                        self.active[host] = self.active.get(host, 0) + 1
+                        return feed
+                self.lock.wait()
+            return None
+
+    def done(self, feed, ok):
+        with self.lock:
+            self.active[feed_host(feed)] -= 1
+            if ok:
+                self.finished.append(feed.id)
+            self.lock.notify_all()
+
+    def work(self):
+        try:
+            while True:
+                feed = self.next_feed()
+                if feed is None:
+                    break
+                ok = False
+                try:
+                    feed.update_cache(force=self.force)
+                    ok = True
+                except Exception:
+                    logger.exception("Refreshing %s:%d failed." % (feed.name, feed.id))
+                finally:
+                    self.done(feed, ok)
+        finally:
+            # Each thread gets its own database connection; don't leak it.
+            connection.close()
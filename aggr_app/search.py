@@ -0,0 +1,96 @@
+"""Search text for entries, and a full-text index over it.
+
+Each Entry stores its title and summary as plain text: tags stripped,
+entities decoded and whitespace collapsed. Filters are run against
+that rather than the raw HTML.
+
+On SQLite the search text is also kept in an FTS5 table with the
+trigram tokenizer, which can find any substring of three or more
+characters. Filters that are just words (or alternatives of words)
+use it to find their candidate entries, so filtering costs about as
+much as there are matches. Other filters, and other databases, read
+the entries and test them in Python.
+"""
+from django.db import connections, transaction, DatabaseError
+from HTMLParser import HTMLParser
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+index_table = 'aggr_app_entry_search'
+
+_index_sql = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS %(index)s USING fts5(search_text, content='%(entry)s', content_rowid='id', tokenize='trigram')",
+    # External content tables have to be kept in step by hand.
+    "CREATE TRIGGER IF NOT EXISTS %(index)s_insert AFTER INSERT ON %(entry)s BEGIN "
+    "INSERT INTO %(index)s (rowid, search_text) VALUES (new.id, new.search_text); END",
+    "CREATE TRIGGER IF NOT EXISTS %(index)s_delete AFTER DELETE ON %(entry)s BEGIN "
+    "INSERT INTO %(index)s (%(index)s, rowid, search_text) VALUES ('delete', old.id, old.search_text); END",
+    "CREATE TRIGGER IF NOT EXISTS %(index)s_update AFTER UPDATE ON %(entry)s BEGIN "
+    "INSERT INTO %(index)s (%(index)s, rowid, search_text) VALUES ('delete', old.id, old.search_text); "
+    "INSERT INTO %(index)s (rowid, search_text) VALUES (new.id, new.search_text); END",
+    # Indexes whatever entries already exist.
+    "INSERT INTO %(index)s (%(index)s) VALUES ('rebuild')",
+]
+
+_hidden_elements = re.compile(r'<(script|style)\b.*?</\1\s*>', re.I | re.S)
+_tags = re.compile(r'<[^>]*>')
+_whitespace = re.compile(r'\s+', re.U)
+_unescaper = HTMLParser()
+
+def html_to_text(html):
+    """Returns the text of an HTML fragment, with its whitespace collapsed."""
+    text = _tags.sub(' ', _hidden_elements.sub(' ', html or u''))
+    text = _unescaper.unescape(text)
+    return _whitespace.sub(' ', text).strip()
+
+def search_text(title, summary):
+    """Returns the text filters are matched against: the title, then the summary."""
+    return u"%s\n%s" % (html_to_text(title), html_to_text(summary))
+
+def create_index(connection, entry_table):
+    """Creates the full-text index and the triggers keeping it up to date.
+
+    Safe to call again (flush does, for one); the index is rebuilt.
+
+    Returns False if the database can't have one.
+    """
+    if connection.vendor != 'sqlite':
+        return False
+    cursor = connection.cursor()
+    try:
+        for statement in _index_sql:
+            cursor.execute(statement % {'index': index_table, 'entry': entry_table})
+    except DatabaseError, e:
+        # Built without FTS5, or too old for the trigram tokenizer.
+        transaction.rollback_unless_managed(using=connection.alias)
+        logger.warning("Not creating the entry search index: %s" % e)
+        return False
+    transaction.commit_unless_managed(using=connection.alias)
+    return True
+
+def has_index(connection):
+    """Whether the database has the full-text index."""
+    if connection.vendor != 'sqlite':
+        return False
+    cursor = connection.cursor()
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [index_table])
+    return cursor.fetchone() is not None
+
+def restrict(entries, terms):
+    """Narrows an Entry queryset to entries containing one of the terms.
+
+    The match ignores case and terms must be three characters or more,
+    so the entries are only candidates; they still need testing with
+    the filters. Returns None if the index can't be used.
+    """
+    connection = connections[entries.db]
+    if not terms or any(len(term) < 3 for term in terms) or not has_index(connection):
+        return None
+    query = u" OR ".join(u'"%s"' % term.replace(u'"', u'""') for term in terms)
+    table = connection.ops.quote_name(entries.model._meta.db_table)
+    return entries.extra(
+        where=["%s.id IN (SELECT rowid FROM %s WHERE %s MATCH %%s)" % (table, index_table, index_table)],
+        params=[query],
+    )
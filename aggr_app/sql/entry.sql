@@ -0,0 +1,2 @@
+-- Lets a feed's entries be read newest first straight off an index.
+CREATE INDEX aggr_app_entry_feed_published ON aggr_app_entry (feed_id, published, id);
@@ -0,0 +1,2 @@
+-- Lets an aggregate's page be read newest first straight off an index.
+CREATE INDEX aggr_app_membership_page ON aggr_app_membership (aggregate_id, published, entry_id);
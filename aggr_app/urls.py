@@ -2,15 +2,19 @@ from django.conf.urls import patterns, include, url
 from django.views.generic import DeleteView
 from aggr_app.models import Aggregate
 from aggr_app.feeds import AggregateFeed
+from aggr_app.caching import cached_page, aggr_validators
+from aggr_app.access import counts_reads
 
 urlpatterns = patterns('aggr_app.views',
     url(r'^$', 'index'),
     url(r'^feed/(?P<feed_id>\d+)/$', 'feed_detail'),
     url(r'^feed/new/$', 'new_feed'),
+    url(r'^feed/search/$', 'feed_search'),
     url(r'^feed/(?P<feed_id>\d+)/delete/$', 'delete_feed'),
     url(r'^aggr/(?P<aggr_id>\d+)/$', 'aggr_detail'),
     url(r'^aggr/new/$', 'new_aggr'),
     url(r'^aggr/(?P<aggr_id>\d+)/modify/$', 'new_aggr'),
     url(r'^aggr/(?P<aggr_id>\d+)/delete/$', 'delete_aggr'),
-    url(r'^rss/(?P<aggr_id>\d+)/$', AggregateFeed(), name='aggr-rss'),
+    url(r'^metrics/$', 'metrics'),
+    url(r'^rss/(?P<aggr_id>\d+)/$', counts_reads(Aggregate, 'aggr_id')(cached_page(aggr_validators)(AggregateFeed())), name='aggr-rss'),
 )
@@ -1,33 +1,50 @@
-from aggr_app.models import Feed, FilteredFeed, Aggregate
+from aggr_app.models import Feed, Entry, FilteredFeed, Aggregate, RefreshLog, RebuildLog, parse_cursor
 from aggr_app.feeds import AggregateFeed
 from aggr_app.forms import NewFeedForm, NewAggrForm
+from aggr_app.caching import cached_page, feed_validators, aggr_validators
+from aggr_app.access import counts_reads
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.urlresolvers import reverse
+from django.db.models import Avg, Count, Sum
 from django.http import HttpResponse, HttpResponseRedirect
 from django.shortcuts import render, render_to_response, get_object_or_404
 from django.template import RequestContext
 import feedparser
+import json
 import logging
 
 logger = logging.getLogger(__name__)
 
 def index(request):
     """Lists all Feeds and Aggregates by name."""
-    feed_list = Feed.objects.all().order_by('-last_updated')
-    aggr_list = Aggregate.objects.all().order_by('-name')
+    # Only the names are shown; don't load the pickled columns.
+    feed_list = Feed.objects.only('id', 'name').order_by('-last_updated')
+    aggr_list = Aggregate.objects.only('id', 'name').order_by('-name')
     return render(
         request,
         'aggr_app/index.html', 
         {'feed_list': feed_list, 'aggr_list': aggr_list}
     )
 
+def page_size():
+    """Returns the number of entries shown per page."""
+    return getattr(settings, 'AGGR_PAGE_SIZE', 50)
+
+@counts_reads(Feed, 'feed_id')
+@cached_page(feed_validators)
 def feed_detail(request, feed_id):
-    """Displays all entries in a given feed."""
+    """Displays a page of entries in a given feed, as of its last refresh.
+    
+    ?before=<cursor> pages back through older entries.
+    """
     feed = get_object_or_404(Feed, pk=feed_id)
-    feed.update_cache()
+    before = parse_cursor(request.GET.get('before'))
+    (entries, next_cursor) = Entry.objects.page(feed.id, before=before, size=page_size())
     return render(
         request,
         'aggr_app/feed_detail.html',
-        {'feed': feed}
+        {'feed': feed, 'entries': entries, 'paged': bool(before), 'next_cursor': next_cursor}
     )
 
 def new_feed(request):
@@ -77,6 +94,12 @@ def new_feed(request):
             )
             
 
+def feed_search(request):
+    """Returns up to 20 feeds whose names contain ?q=, as JSON [{id, name}]."""
+    feeds = Feed.objects.filter(name__icontains=request.GET.get('q', '')).order_by('name')
+    data = [{'id': id, 'name': name} for (id, name) in feeds.values_list('id', 'name')[:20]]
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
 def delete_feed(request, feed_id):
     """Confirm (GET) and delete (POST) an Feed.
     
@@ -84,7 +107,7 @@ def delete_feed(request, feed_id):
     POST: do the actual deletion.
     """
     if request.method == 'GET':
-        feed = Feed.objects.get(pk=feed_id)
+        feed = Feed.objects.only('id', 'name').get(pk=feed_id)
         return render(
             request,
             'aggr_app/feed_delete.html',
@@ -99,7 +122,7 @@ def delete_feed(request, feed_id):
                     request,
                     'aggr_app/feed_delete.html',
                     {
-                        'feed': Feed.objects.get(pk=feed_id),
+                        'feed': Feed.objects.only('id', 'name').get(pk=feed_id),
                         'error_message': 'Feed IDs do not match. Something went wrong!'
                     },
                     context_instance=RequestContext(request)
@@ -115,25 +138,30 @@ def delete_feed(request, feed_id):
                 request,
                 'aggr_app/feed_delete.html',
                 {
-                    'feed': Feed.objects.get(pk=feed_id),
+                    'feed': Feed.objects.only('id', 'name').get(pk=feed_id),
                     'error_message': 'Something is missing.'
                 }
             )
         else:
-            feed = Feed.objects.get(pk=feed_id)
-            feed.delete()
+            Feed.objects.filter(pk=feed_id).delete()
             return HttpResponseRedirect(reverse('aggr_app.views.index'))
 
+@counts_reads(Aggregate, 'aggr_id')
+@cached_page(aggr_validators)
 def aggr_detail(request, aggr_id):
-    """Shows all entries (filtered) in a given Aggregate."""
+    """Shows a page of the (filtered) entries in a given Aggregate.
+    
+    ?before=<cursor> pages back through older entries.
+    """
     aggr = get_object_or_404(Aggregate, pk=aggr_id)
-    aggr.apply_filters()
-    aggr.save()
+    aggr.update_items()
+    before = parse_cursor(request.GET.get('before'))
+    (items, next_cursor) = aggr.page(before=before, size=page_size())
     rss_url = reverse('aggr-rss', args=(aggr.id,))
     return render(
         request,
         'aggr_app/aggr_detail.html',
-        {'aggr': aggr, 'rss_url': rss_url}
+        {'aggr': aggr, 'items': items, 'paged': bool(before), 'next_cursor': next_cursor, 'rss_url': rss_url}
     )
 
 def new_aggr(request, aggr_id=None):
@@ -145,7 +173,7 @@ def new_aggr(request, aggr_id=None):
     logger.debug("aggr_id=%s" % aggr_id)
     if request.method == 'GET':
         if aggr_id:
-            aggr = Aggregate.objects.get(pk=aggr_id)
+            aggr = Aggregate.objects.only('id', 'name').get(pk=aggr_id)
             form = NewAggrForm(initial={'name': aggr.name}, filters=aggr.feed_tuple())
         else:
             aggr = None
@@ -174,18 +202,19 @@ def new_aggr(request, aggr_id=None):
             logger.debug("Form is valid.")
             if aggr_id:
                 logger.debug("Modifying existing Aggr id=%s" % aggr_id)
-                aggr = Aggregate.objects.get(pk=aggr_id)
-                aggr.name = form.cleaned_data['name']
+                # Only the name is changed here; leave the rest unloaded.
+                aggr = Aggregate.objects.only('id').get(pk=aggr_id)
+                Aggregate.objects.filter(pk=aggr_id).update(name=form.cleaned_data['name'])
             else:
                 logger.debug("Creating new Aggr")
                 aggr = Aggregate(name=form.cleaned_data['name'])
+                aggr.save()
             
             feed_filters = []
             logger.debug("filter_count=%d" % (filter_count,))
             for (feed, feed_filter) in (('feed%d'%i, 'filter%d'%i) for i in range(filter_count)):
-                feed_obj = Feed.objects.get(pk=form.cleaned_data[feed])
-                logger.debug(feed_obj)
-                filtered_feed = FilteredFeed(feed=feed_obj, re_filter=form.cleaned_data[feed_filter])
+                # The form has checked the feed exists; no need to load it.
+                filtered_feed = FilteredFeed(feed_id=int(form.cleaned_data[feed]), re_filter=form.cleaned_data[feed_filter])
                 filtered_feed.save()
                 feed_filters.append(filtered_feed)
         else:
@@ -203,12 +232,8 @@ def new_aggr(request, aggr_id=None):
                     'filter_fields': filter_fields
                 }
             )
-        # Pre-save the model before we can use the ManyToManyField.
-        if not aggr_id:
-            aggr.save()
         logger.debug(feed_filters)
         aggr.feeds = feed_filters
-        aggr.save()
         logger.debug("success")
         return HttpResponseRedirect(
             reverse('aggr_app.views.aggr_detail',
@@ -222,7 +247,7 @@ def delete_aggr(request, aggr_id):
     With POST, do the actual deletion.
     """
     if request.method == 'GET':
-        aggr = Aggregate.objects.get(pk=aggr_id)
+        aggr = Aggregate.objects.only('id', 'name').get(pk=aggr_id)
         return render(
             request,
             'aggr_app/aggr_delete.html',
@@ -236,7 +261,7 @@ def delete_aggr(request, aggr_id):
                     request,
                     'aggr_app/aggr_delete.html',
                     {
-                        'aggr': Aggregate.objects.get(pk=aggr_id),
+                        'aggr': Aggregate.objects.only('id', 'name').get(pk=aggr_id),
                         'error_message': 'Feed IDs do not match.'
                     },
                     context_instance=RequestContext(request)
@@ -246,20 +271,58 @@ def delete_aggr(request, aggr_id):
                     reverse('aggr_app.views.aggr_detail',
                     args=(aggr_id,))
                 )
-            aggr = Aggregate.objects.get(pk=aggr_id)
         except KeyError:
             return render(
                 request,
                 'aggr_app/aggr_delete.html',
                 {
-                    'aggr': Aggregate.objects.get(pk=aggr_id),
+                    'aggr': Aggregate.objects.only('id', 'name').get(pk=aggr_id),
                     'error_message': 'Something is missing.'
                 },
                 context_instance=RequestContext(request)
             )
         else:
-            for feed in aggr.feeds.all():
-                feed.delete()
-            aggr.delete()
+            FilteredFeed.objects.filter(aggregate=aggr_id).delete()
+            Aggregate.objects.filter(pk=aggr_id).delete()
             return HttpResponseRedirect(reverse('aggr_app.views.index'))
 
+def metrics(request):
+    """Returns the recorded refresh and rebuild metrics as JSON.
+    
+    Without arguments, totals and averages per feed and per aggregate
+    over their recent history, the most time-consuming first.
+    ?feed=<id> or ?aggr=<id> returns that one's recent logs instead.
+    """
+    if request.GET.get('feed'):
+        logs = RefreshLog.objects.recent().filter(feed=request.GET['feed'])
+        data = {'refreshes': list(logs.values())}
+    elif request.GET.get('aggr'):
+        logs = RebuildLog.objects.recent().filter(aggregate=request.GET['aggr'])
+        data = {'rebuilds': list(logs.values())}
+    else:
+        feeds = RefreshLog.objects.values('feed', 'feed__name').annotate(
+            refreshes=Count('id'),
+            total_time=Sum('total_time'),
+            avg_dns_time=Avg('dns_time'),
+            avg_connect_time=Avg('connect_time'),
+            avg_wait_time=Avg('wait_time'),
+            avg_transfer_time=Avg('transfer_time'),
+            avg_parse_time=Avg('parse_time'),
+            avg_save_time=Avg('save_time'),
+            bytes_received=Sum('bytes_received'),
+            entries_added=Sum('entries_added'),
+        ).order_by('-total_time')
+        feeds = list(feeds)
+        outcomes = RefreshLog.objects.values_list('feed', 'outcome').annotate(count=Count('id')).order_by()
+        by_feed = dict((row['feed'], row) for row in feeds)
+        for (feed_id, outcome, count) in outcomes:
+            by_feed[feed_id].setdefault('outcomes', {})[outcome] = count
+        aggregates = RebuildLog.objects.values('aggregate', 'aggregate__name').annotate(
+            rebuilds=Count('id'),
+            total_time=Sum('total_time'),
+            avg_filter_time=Avg('filter_time'),
+            avg_save_time=Avg('save_time'),
+            items_added=Sum('items_added'),
+        ).order_by('-total_time')
+        data = {'feeds': feeds, 'aggregates': list(aggregates)}
+    return HttpResponse(json.dumps(data, cls=DjangoJSONEncoder, indent=1), content_type='application/json')